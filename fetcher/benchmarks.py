@@ -0,0 +1,368 @@
+"""End-to-end benchmarks for fetch runs, replaying the VCR cassettes in fixtures/cassettes.
+
+Requests to ArchivesSpace, Cartographer and the index are answered by a local
+stand-in server using recorded responses, so runs are reproducible and can be
+compared between commits. Run from the project root with:
+
+    python manage.py benchmark_fetch [--latency 50] [--output results.json]
+"""
+
+import asyncio
+import glob
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlsplit
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from merger.helpers import cartographer_cache
+from pisces import settings
+from transformer.models import DataObject, IdentifierMapping
+
+from .helpers import identifier_from_uri
+from .models import DeleteRequest, FetchRun
+
+CASSETTES_DIR = os.path.join("fixtures", "cassettes")
+IGNORED_PARAMS = ("username", "password", "modified_since", "deleted_since")
+RECORDED_USERNAME = "admin"
+RECORDED_REPO = 101
+DELETE_PATH = "/index/delete/"
+STAGES = ("get_fetched", "fetch_stage", "merge_stage", "transform_stage", "persist_stage")
+
+
+def request_key(method, uri):
+    """Returns a key matching a request regardless of host and ignored parameters."""
+    parts = urlsplit(uri)
+    query = tuple(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS))
+    return (method.upper(), parts.path, query)
+
+
+def load_cassettes(cassettes_dir=CASSETTES_DIR):
+    """Returns recorded responses from all cassettes, keyed by request.
+
+    Responses are also keyed by method and path alone, which is used for
+    requests whose parameters were not recorded exactly, such as those to
+    Cartographer.
+    """
+    responses = {}
+    for filename in sorted(glob.glob(os.path.join(cassettes_dir, "*", "*.json"))):
+        with open(filename, "r") as cassette:
+            for interaction in json.load(cassette)["interactions"]:
+                key = request_key(interaction["request"]["method"], interaction["request"]["uri"])
+                responses[key] = interaction["response"]
+                responses.setdefault(key[:2], interaction["response"])
+    return responses
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.replay()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self.replay()
+
+    def replay(self):
+        time.sleep(self.server.latency)
+        key = request_key(self.command, self.path)
+        response = self.server.responses.get(key, self.server.responses.get(key[:2]))
+        if response:
+            status = response["status"]["code"]
+            content_type = response["headers"].get("Content-Type", ["application/json"])[0]
+            body = (response["body"]["string"] or "").encode("utf-8")
+        elif self.command == "POST" and key[1] == DELETE_PATH:
+            status, content_type, body = 200, "application/json", b"{}"
+        else:
+            status, content_type, body = 404, "application/json", b'{"detail": "Not recorded"}'
+            self.server.record_unmatched(self.command, self.path)
+        self.server.record_request()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server which answers requests with recorded responses.
+
+    Args:
+        responses (dict): responses returned by load_cassettes.
+        latency (float): seconds to wait before answering each request.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responses, latency=0):
+        super().__init__(("127.0.0.1", 0), ReplayHandler)
+        self.responses = responses
+        self.latency = latency
+        self.requests = 0
+        self.unmatched = set()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_unmatched(self, method, path):
+        with self.lock:
+            self.unmatched.add("{} {}".format(method, path))
+
+    def reset_counts(self):
+        """Returns the number of requests answered and those with no recorded response."""
+        with self.lock:
+            counts = {"requests": self.requests, "unmatched": sorted(self.unmatched)}
+            self.requests, self.unmatched = 0, set()
+        return counts
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class QueryCounter:
+    """Counts database queries made on every connection, in every thread."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def reset(self):
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+    def __enter__(self):
+        for connection in connections.all():
+            self.install(connection=connection)
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.install)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class StageTimer:
+    """Records how long a fetcher spends handling each item in each stage."""
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+
+    def attach(self, fetcher):
+        for name in STAGES:
+            setattr(fetcher, name, self.timed(name, getattr(fetcher, name)))
+
+    def timed(self, name, handler):
+        if asyncio.iscoroutinefunction(handler):
+            async def timed_handler(*args):
+                start = time.perf_counter()
+                try:
+                    return await handler(*args)
+                finally:
+                    self.timings[name].append(time.perf_counter() - start)
+        else:
+            def timed_handler(*args):
+                start = time.perf_counter()
+                try:
+                    return handler(*args)
+                finally:
+                    self.timings[name].append(time.perf_counter() - start)
+        return timed_handler
+
+    def summary(self):
+        return {name: summarize(values) for name, values in self.timings.items()}
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "total": sum(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95)}
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+@contextmanager
+def replay_settings(url):
+    """Points all clients at a ReplayServer and disables probes and email."""
+    saved = (
+        dict(settings.ARCHIVESSPACE), dict(settings.CARTOGRAPHER),
+        settings.INDEX_DELETE_URL, settings.PROBE_CHANGES)
+    settings.ARCHIVESSPACE.update(baseurl=url, username=RECORDED_USERNAME, repo=RECORDED_REPO)
+    settings.CARTOGRAPHER.update(baseurl=url)
+    settings.INDEX_DELETE_URL = url + DELETE_PATH
+    settings.PROBE_CHANGES = False
+    try:
+        with override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend"):
+            yield
+    finally:
+        settings.ARCHIVESSPACE.clear()
+        settings.ARCHIVESSPACE.update(saved[0])
+        settings.CARTOGRAPHER.clear()
+        settings.CARTOGRAPHER.update(saved[1])
+        settings.INDEX_DELETE_URL, settings.PROBE_CHANGES = saved[2:]
+
+
+def reset_state():
+    """Removes data and cached lookups left by previous runs, so each run starts cold."""
+    for model in (DataObject, IdentifierMapping, DeleteRequest, FetchRun):
+        model.objects.all().delete()
+    cartographer_cache.clear()
+    identifier_from_uri.cache_clear()
+
+
+def benchmark_job(job, server, queries):
+    """Runs a fetch job once against a ReplayServer.
+
+    Returns:
+        dict: the number of records processed, elapsed seconds, records per
+        second, per-stage timings, database queries, HTTP requests, errors
+        and peak RSS.
+    """
+    reset_state()
+    server.reset_counts()
+    queries.reset()
+    fetcher = job.fetcher()
+    timer = StageTimer()
+    timer.attach(fetcher)
+    start = time.perf_counter()
+    try:
+        processed = fetcher.fetch(job.object_status, job.object_type)
+        error = None
+    except Exception as e:
+        processed = getattr(fetcher, "processed", 0)
+        error = str(e)
+    elapsed = time.perf_counter() - start
+    run = FetchRun.objects.filter(parent__isnull=True).order_by("-start_time").first()
+    return {
+        "processed": processed,
+        "seconds": elapsed,
+        "per_second": processed / elapsed if elapsed else 0,
+        "stages": timer.summary(),
+        "queries": queries.reset(),
+        "http": server.reset_counts(),
+        "errors": run.error_count if run else 0,
+        "error": error,
+        "peak_rss_kb": peak_rss(),
+    }
+
+
+def benchmark_fetch(jobs, iterations=1, latency=0, cassettes_dir=CASSETTES_DIR):
+    """Runs each fetch job end to end against recorded responses.
+
+    Must be run against a database which can be emptied, since all fetch
+    runs and DataObjects are removed before each run.
+
+    Args:
+        jobs (list): fetch job classes, see cron.FETCH_JOBS.
+        iterations (int): number of times to run each job.
+        latency (float): seconds the stand-in server waits before each response.
+
+    Returns:
+        dict: environment details, and results for each job keyed by source,
+        object status and object type, with the results of every iteration
+        and the median records per second.
+    """
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "latency": latency,
+        "iterations": iterations,
+        "pipeline": dict(settings.PIPELINE),
+        "jobs": {},
+    }
+    with ReplayServer(load_cassettes(cassettes_dir), latency=latency) as server, QueryCounter() as queries:
+        with replay_settings(server.url):
+            for job in jobs:
+                source = [s[1] for s in FetchRun.SOURCE_CHOICES if s[0] == job.fetcher.source][0]
+                runs = [benchmark_job(job, server, queries) for _ in range(iterations)]
+                results["jobs"]["{}-{}-{}".format(source, job.object_status, job.object_type)] = {
+                    "runs": runs,
+                    "per_second": percentile([r["per_second"] for r in runs], 50)}
+    results["peak_rss_kb"] = peak_rss()
+    return results
+
+
+def compare_results(baseline, results):
+    """Returns the change in median records per second of each job from a baseline.
+
+    Returns:
+        dict: job names mapped to the ratio of new to baseline throughput,
+        for jobs present in both results.
+    """
+    changes = {}
+    for name, job in results["jobs"].items():
+        before = baseline["jobs"].get(name, {}).get("per_second")
+        if before:
+            changes[name] = job["per_second"] / before
+    return changes
+
+
+def print_results(results, changes=None):
+    changes = changes if changes else {}
+    for name, job in results["jobs"].items():
+        print("{:<50} {:>10.1f}/s {:>8}".format(
+            name, job["per_second"], "{:+.1%}".format(changes[name] - 1) if name in changes else ""))
+        for stage, timing in job["runs"][-1]["stages"].items():
+            print("    {:<20} {:>6} {:>10.4f}s p50 {:>10.4f}s p95".format(
+                stage, timing["count"], timing["p50"], timing["p95"]))
+    print("Peak RSS: {} KB".format(results["peak_rss_kb"]))
@@ -0,0 +1,113 @@
+from pisces import settings
+
+from .models import FetchRun
+
+
+class CheckpointMixin:
+    """Checkpoints the progress of fetch runs so interrupted runs can be resumed.
+
+    A run's checkpoint records the modified_since time used to fetch
+    identifiers, how many identifiers have been processed and the last of
+    them, and objects waiting to be deleted. Identifiers are only counted once
+    every identifier before them has been processed and saved, and the
+    checkpoint is no longer advanced once any data could not be saved, so a
+    resumed run never skips unsaved data.
+    """
+
+    def get_interrupted_run(self):
+        """Returns the latest run of this fetch if it was interrupted after saving a checkpoint."""
+        if not (settings.PIPELINE["resume_runs"] and self.object_status == "updated"):
+            return None
+        latest = FetchRun.objects.filter(
+            source=self.source,
+            object_type=self.object_type,
+            object_status=self.object_status,
+            parent__isnull=True).order_by("-start_time").first()
+        if latest and int(latest.status) != FetchRun.FINISHED and latest.checkpoint:
+            return latest
+        return None
+
+    def start_checkpoints(self, fetched, to_delete):
+        """Prepares checkpointing for a run, returning the identifiers left to process."""
+        checkpoint = self.current_run.checkpoint
+        if checkpoint:
+            to_delete.extend(checkpoint["to_delete"])
+            fetched = self.get_remaining(fetched, checkpoint)
+        else:
+            checkpoint.update({
+                "modified_since": self.last_run,
+                "completed": 0,
+                "last_item": None,
+                "to_delete": [],
+                "saved": 0,
+                "unchanged": 0,
+            })
+        checkpoint["total"] = checkpoint["completed"] + len(fetched)
+        self.processed = self.completed = checkpoint["completed"]
+        self.last_item = checkpoint["last_item"]
+        self.checkpoint_base = {"saved": checkpoint["saved"], "unchanged": checkpoint["unchanged"]}
+        self.units = {}
+        self.pending = {}
+        self.completed_units = set()
+        self.next_unit = 0
+        self.checkpointed_unit = 0
+        self.checkpointing = False
+        self.write_failed = False
+        self.current_run.save()
+        return fetched
+
+    def get_remaining(self, fetched, checkpoint):
+        """Returns the identifiers not processed before a run was interrupted."""
+        return fetched[checkpoint["completed"]:]
+
+    def get_unit_items(self, unit):
+        """Returns the identifiers in a fetch unit."""
+        return [unit]
+
+    async def complete_unit(self, unit_index, loop, executor, to_delete):
+        """Records that all data from a fetch unit has been handled, saving a checkpoint at each interval."""
+        del self.pending[unit_index]
+        self.completed_units.add(unit_index)
+        while self.next_unit in self.completed_units:
+            self.completed_units.remove(self.next_unit)
+            items = self.units.pop(self.next_unit)
+            self.completed += len(items)
+            self.last_item = items[-1] if items else self.last_item
+            self.next_unit += 1
+        if self.next_unit - self.checkpointed_unit >= settings.PIPELINE["checkpoint_interval"] and not self.checkpointing:
+            self.checkpointing = True
+            try:
+                await self.save_checkpoint(loop, executor, to_delete)
+            finally:
+                self.checkpointing = False
+
+    async def save_checkpoint(self, loop, executor, to_delete):
+        """Saves buffered data, then the run's checkpoint and metrics."""
+        completed, last_item, next_unit = self.completed, self.last_item, self.next_unit
+        await loop.run_in_executor(executor, self.writer.flush)
+        self.record_write_failures()
+        self.update_checkpoint(completed, last_item, to_delete)
+        self.update_metrics()
+        self.save_errors()
+        await loop.run_in_executor(executor, self.save_run)
+        self.checkpointed_unit = next_unit
+
+    def record_write_failures(self):
+        """Records an error for each object the writer could not save."""
+        for uri, message in self.writer.pop_failed():
+            self.write_failed = True
+            self.record_error("Error saving {}: {}".format(uri, message))
+
+    def update_checkpoint(self, completed, last_item, to_delete):
+        if self.write_failed:
+            completed, last_item = self.current_run.checkpoint["completed"], self.current_run.checkpoint["last_item"]
+        self.current_run.checkpoint = dict(
+            self.current_run.checkpoint,
+            completed=completed,
+            last_item=last_item,
+            to_delete=list(set(to_delete)),
+            saved=self.checkpoint_base["saved"] + self.writer.saved,
+            unchanged=self.checkpoint_base["unchanged"] + self.writer.unchanged)
+
+    def save_run(self):
+        self.current_run.save()
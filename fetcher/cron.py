@@ -3,7 +3,11 @@ from datetime import datetime
 from django_cron import CronJobBase, Schedule
 
 from .fetchers import ArchivesSpaceDataFetcher, CartographerDataFetcher
+from .helpers import instantiate_index_session, replay_delete_requests
+from .metrics import delete_runs
 from .models import FetchRun
+from .scheduler import Scheduler
+from .sharding import claim_shard
 
 
 class BaseCron(CronJobBase):
@@ -21,10 +25,12 @@ class BaseCron(CronJobBase):
             status=FetchRun.FINISHED,
             source=self.fetcher.source,
             object_type=self.object_type,
-            object_status=self.object_status).order_by("-end_time")[0]
+            object_status=self.object_status,
+            parent__isnull=True).order_by("-start_time").first()
         print("{} records exported in {}".format(out, end - start))
-        if fetch_run.error_count:
-            print("{} errors".format(fetch_run.error_count))
+        error_count = fetch_run.error_count if fetch_run else 0
+        if error_count:
+            print("{} errors".format(error_count))
             for e in fetch_run.errors:
                 print("    {}".format(e.message))
         print("Export of {} {} records from {} complete at {}\n".format(
@@ -122,6 +128,72 @@ class UpdatedCartographerArrangementMapComponents(BaseCron):
     fetcher = CartographerDataFetcher
 
 
+FETCH_JOBS = [
+    DeletedArchivesSpaceArchivalObjects,
+    DeletedArchivesSpaceFamilies,
+    DeletedArchivesSpaceOrganizations,
+    DeletedArchivesSpacePeople,
+    DeletedArchivesSpaceResources,
+    DeletedArchivesSpaceSubjects,
+    UpdatedArchivesSpaceArchivalObjects,
+    UpdatedArchivesSpaceFamilies,
+    UpdatedArchivesSpaceOrganizations,
+    UpdatedArchivesSpacePeople,
+    UpdatedArchivesSpaceResources,
+    UpdatedArchivesSpaceSubjects,
+    UpdatedCartographerArrangementMapComponents,
+]
+
+
+class ScheduledFetches(CronJobBase):
+    """Runs all fetch jobs, ordered and parallelized by the scheduler."""
+    code = "fetcher.scheduled_fetches"
+    RUN_EVERY_MINS = 0
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+
+    def do(self):
+        Scheduler(FETCH_JOBS).run()
+
+
+class ProcessFetchShards(CronJobBase):
+    """Processes shards of sharded runs from any source.
+
+    Run this job in additional processes or on other hosts sharing the
+    database to spread large runs across workers.
+    """
+    code = "fetcher.process_fetch_shards"
+    RUN_EVERY_MINS = 0
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    fetchers = {
+        FetchRun.ARCHIVESSPACE: ArchivesSpaceDataFetcher,
+        FetchRun.CARTOGRAPHER: CartographerDataFetcher,
+    }
+
+    def do(self):
+        while True:
+            shard = claim_shard()
+            if not shard:
+                break
+            start = datetime.now()
+            try:
+                out = self.fetchers[int(shard.source)]().fetch_shard(shard)
+                print("{} {} records in shard {} exported in {}".format(
+                    out, shard.object_type, shard.pk, datetime.now() - start))
+            except Exception as e:
+                print("Error processing shard {}: {}".format(shard.pk, e))
+
+
+class ReplayDeleteRequests(CronJobBase):
+    """Resends delete requests which could not be delivered to the index."""
+    code = "fetcher.replay_delete_requests"
+    RUN_EVERY_MINS = 0
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+
+    def do(self):
+        delivered = replay_delete_requests(instantiate_index_session())
+        print("{} delete requests replayed".format(delivered))
+
+
 class CleanUpCompleted(CronJobBase):
     code = "fetcher.cleanup_completed"
     RUN_EVERY_MINS = 0
@@ -135,8 +207,9 @@ class CleanUpCompleted(CronJobBase):
                         object_type=obj_type,
                         object_status=obj_status,
                         status=FetchRun.FINISHED,
+                        parent__isnull=True,
                         fetchrunerror__isnull=True).order_by("-end_time")[1:].values_list("id", flat=True)
-                    FetchRun.objects.filter(pk__in=list(delete_ids)).delete()
+                    delete_ids = delete_runs(FetchRun.objects.filter(pk__in=list(delete_ids)))
                     print("{} {} FetchRun objects deleted".format(len(delete_ids), obj_type))
         except Exception as e:
             print("Error cleaning  up completed FetchRun objects: {}".format(e))
@@ -1,32 +1,48 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from django.utils import timezone
+from electronbonder.client import ElectronBond
+from merger.helpers import CartographerHelper, LRUCache
 from merger.mergers import (AgentMerger, ArchivalObjectMerger,
                             ArrangementMapMerger, ResourceMerger,
                             SubjectMerger)
 from pisces import settings
-from transformer.transformers import Transformer
-
-from .helpers import (handle_deleted_uris, instantiate_aspace,
-                      instantiate_electronbond, last_run_time, list_chunks,
-                      send_error_notification)
+from transformer.transformers import (DataObjectWriter, Transformer,
+                                      TransformValidationError,
+                                      get_content_hash, init_transform_process)
+from transformer.validators import sampler
+
+from .checkpoints import CheckpointMixin
+from .helpers import (DeleteNotifier, close_thread_connections,
+                      instantiate_aspace, instantiate_async_aspace,
+                      instantiate_async_electronbond, instantiate_electronbond,
+                      instantiate_index_session, instantiate_session,
+                      last_run_time, list_chunks, send_error_notification,
+                      session_stats)
+from .metrics import MetricsMixin
 from .models import FetchRun, FetchRunError
+from .profiling import RunProfiler, claim_profile_request
+from .sharding import ShardingMixin, finish_parent_run
 
 
 class FetcherError(Exception):
     pass
 
 
-def run_transformer(merged_object_type, merged):
-    Transformer().run(merged_object_type, merged)
+def run_transformer(merged_object_type, merged, should_validate=None):
+    transformed = Transformer().transform(merged_object_type, merged, should_validate)
+    return transformed, get_content_hash(transformed)
 
 
-def run_merger(merger, object_type, fetched):
-    return merger(clients).merge(object_type, fetched)
+def run_merger(merger, object_type, fetched, cache):
+    return merger(clients, cache).merge(object_type, fetched)
 
 
-class BaseDataFetcher:
+class BaseDataFetcher(CheckpointMixin, MetricsMixin, ShardingMixin):
     """Base data fetcher.
 
     Provides a common run method inherited by other fetchers. Requires a source
@@ -36,90 +52,284 @@ class BaseDataFetcher:
     def fetch(self, object_status, object_type):
         self.object_status = object_status
         self.object_type = object_type
-        self.last_run = last_run_time(self.source, object_status, object_type)
+        sharded_run = self.get_sharded_run()
+        if sharded_run:
+            return self.process_shards(sharded_run)
+        self.current_run = self.get_interrupted_run()
+        if self.current_run:
+            self.last_run = self.current_run.checkpoint["modified_since"]
+            self.current_run.status = FetchRun.STARTED
+            self.current_run.end_time = None
+            self.current_run.metrics["resumed"] = self.current_run.metrics.get("resumed", 0) + 1
+            self.current_run.save()
+        else:
+            self.last_run = last_run_time(self.source, object_status, object_type)
+            if settings.PROBE_CHANGES and self.last_run and not self.has_changes():
+                self.record_skipped_run()
+                return 0
+        return self.run_fetch()
+
+    def has_changes(self):
+        """Asks the source whether anything changed since the last run, assuming so if the probe fails."""
+        try:
+            return getattr(self, "count_{}".format(self.object_status))() > 0
+        except Exception as e:
+            print("Unable to count {} {} objects: {}".format(self.object_status, self.object_type, e))
+            return True
+
+    def record_skipped_run(self):
+        """Records a probe which found no changes on the last finished run."""
+        last_finished = FetchRun.objects.filter(
+            status=FetchRun.FINISHED,
+            source=self.source,
+            object_type=self.object_type,
+            object_status=self.object_status,
+            parent__isnull=True).order_by("-start_time").first()
+        if last_finished:
+            last_finished.metrics["skipped"] = last_finished.metrics.get("skipped", 0) + 1
+            last_finished.metrics["last_probe"] = timezone.now().timestamp()
+            last_finished.save(update_fields=["metrics"])
+
+    def run_fetch(self):
         global clients
         clients = self.instantiate_clients()
         self.processed = 0
-        self.current_run = FetchRun.objects.create(
-            status=FetchRun.STARTED,
-            source=self.source,
-            object_type=object_type,
-            object_status=object_status)
-        self.merger = self.get_merger(object_type)
+        if not self.current_run:
+            self.current_run = FetchRun.objects.create(
+                status=FetchRun.STARTED,
+                source=self.source,
+                object_type=self.object_type,
+                object_status=self.object_status)
+        self.merger = self.get_merger(self.object_type)
+        self.cache = LRUCache(settings.MERGE_CACHE_SIZE)
+        self.errors = []
+        self.profiler = self.get_profiler()
+        self.start_metrics()
 
         try:
-            fetched = getattr(
-                self, "get_{}".format(self.object_status))()
-            asyncio.get_event_loop().run_until_complete(
-                self.process_fetched(fetched))
+            start = time.perf_counter()
+            fetched = self.get_fetched()
+            self.stage_metrics["list"]["seconds"] += time.perf_counter() - start
+            self.current_run.metrics["fetched"] = len(fetched)
+            if self.should_shard(fetched):
+                self.create_shards(fetched)
+            else:
+                self.profile_loop(fetched)
         except Exception as e:
             self.current_run.status = FetchRun.ERRORED
             self.current_run.end_time = timezone.now()
+            self.update_metrics()
+            self.save_profile()
             self.current_run.save()
-            FetchRunError.objects.create(
-                run=self.current_run,
-                message="Error fetching data: {}".format(e),
-            )
+            self.record_error("Error fetching data: {}".format(e))
+            self.save_errors()
+            if self.current_run.parent_id:
+                finish_parent_run(self.current_run.parent)
             raise FetcherError(e)
 
+        if self.current_run.metrics.get("shards"):
+            return self.process_shards(self.current_run)
         self.current_run.status = FetchRun.FINISHED
         self.current_run.end_time = timezone.now()
+        self.update_metrics()
+        self.save_profile()
         self.current_run.save()
+        self.save_errors()
+        if self.current_run.parent_id:
+            finish_parent_run(self.current_run.parent)
         if self.current_run.error_count > 0:
             send_error_notification(self.current_run)
         return self.processed
 
+    def get_profiler(self):
+        """Returns a RunProfiler if sampling is configured or profiling was requested, otherwise None."""
+        sample_rate = claim_profile_request(self.source, self.object_type, self.object_status)
+        sample_rate = sample_rate if sample_rate else settings.PROFILING["sample_rate"]
+        return RunProfiler(sample_rate) if sample_rate else None
+
+    def profile_loop(self, fetched):
+        """Processes fetched data, profiling the event loop as the "loop" stage if the run is profiled."""
+        process = asyncio.get_event_loop().run_until_complete
+        if self.profiler:
+            self.profiler.runcall("loop", process, self.process_fetched(fetched))
+        else:
+            process(self.process_fetched(fetched))
+
+    def profile(self, stage, func, *args):
+        """Calls func, profiling it if the run is profiled and the call is sampled."""
+        if self.profiler and self.profiler.should_profile(stage):
+            return self.profiler.runcall(stage, func, *args)
+        return func(*args)
+
+    def save_profile(self):
+        if self.profiler:
+            self.current_run.profile = self.profiler.summary()
+
+    def record_error(self, message):
+        """Buffers an error for the current run until save_errors is called."""
+        self.errors.append(FetchRunError(run=self.current_run, message=message, datetime=timezone.now()))
+
+    def save_errors(self):
+        """Saves buffered errors in a single query."""
+        errors, self.errors = self.errors, []
+        FetchRunError.objects.bulk_create(errors)
+
     def instantiate_clients(self):
         return {
             "aspace": instantiate_aspace(settings.ARCHIVESSPACE),
-            "cartographer": instantiate_electronbond(settings.CARTOGRAPHER)
+            "cartographer": instantiate_electronbond(settings.CARTOGRAPHER),
+            "index": instantiate_index_session(),
+        }
+
+    def get_connection_stats(self):
+        """Returns request and connection reuse counts for each client used in the run."""
+        stats = {
+            "aspace": session_stats(clients["aspace"].client.session),
+            "cartographer": session_stats(clients["cartographer"].session),
+            "index": session_stats(clients["index"]),
         }
+        if getattr(self, "async_client", None):
+            stats["async"] = self.async_client.stats
+        return stats
 
     async def process_fetched(self, fetched):
-        tasks = []
-        to_delete = []
         loop = asyncio.get_event_loop()
-        executor = ThreadPoolExecutor()
-        if self.object_status == "updated":
-            if self.source == FetchRun.ARCHIVESSPACE:
-                semaphore = asyncio.BoundedSemaphore(settings.CHUNK_SIZE / self.page_size)
-                for id_chunk in list_chunks(fetched, self.page_size):
-                    task = asyncio.ensure_future(self.handle_page(id_chunk, loop, executor, semaphore, to_delete))
-                    tasks.append(task)
-            else:
-                semaphore = asyncio.BoundedSemaphore(settings.CHUNK_SIZE)
-                for obj in fetched:
-                    task = asyncio.ensure_future(self.handle_item(obj, loop, executor, semaphore, to_delete))
-                    tasks.append(task)
-        else:
-            to_delete = fetched
-            self.processed = len(fetched)
-        tasks.append(asyncio.ensure_future(handle_deleted_uris(to_delete, self.source, self.object_type, self.current_run)))
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-    async def handle_page(self, id_list, loop, executor, semaphore, to_delete):
-        async with semaphore:
-            page = await self.get_page(id_list)
-            for obj in page:
-                await self.handle_data(obj, loop, executor, semaphore, to_delete)
-                self.processed += 1
-
-    async def handle_item(self, identifier, loop, executor, semaphore, to_delete):
-        async with semaphore:
-            item = await self.get_item(identifier)
-            await self.handle_data(item, loop, executor, semaphore, to_delete)
-            self.processed += 1
-
-    async def handle_data(self, data, loop, executor, semaphore, to_delete):
+        # Worker processes are forked before any threads are started, so they
+        # cannot inherit a lock held by another thread.
+        transform_pool = self.start_transform_pool() if self.object_status == "updated" else None
+        workers = (os.cpu_count() or 1) * 5
+        executor = ThreadPoolExecutor(max_workers=workers)
+        self.transform_executor = transform_pool or executor
+        to_delete = DeleteNotifier(
+            self.source, self.object_type, self.current_run, clients["index"], self.record_error, executor)
+        async with self.instantiate_async_client(settings.PIPELINE["fetch_workers"]) as self.async_client:
+            try:
+                if self.object_status == "updated":
+                    await self.run_pipeline(fetched, loop, executor, to_delete)
+                else:
+                    to_delete.extend(fetched)
+                    self.processed = len(fetched)
+            finally:
+                start = time.perf_counter()
+                self.current_run.metrics["deleted"] = len(await to_delete.flush())
+                self.stage_metrics["delete"]["seconds"] += time.perf_counter() - start
+                close_thread_connections(executor, workers)
+                executor.shutdown()
+                if transform_pool:
+                    transform_pool.shutdown()
+
+    def start_transform_pool(self):
+        """Returns a pool of worker processes for transformations, if one is configured."""
+        processes = settings.PIPELINE["transform_processes"]
+        if processes:
+            pool = ProcessPoolExecutor(max_workers=processes)
+            for future in [pool.submit(init_transform_process) for _ in range(processes)]:
+                future.result()
+            return pool
+
+    async def run_pipeline(self, fetched, loop, executor, to_delete):
+        """Moves fetched data through bounded queues for the fetch, merge, transform and persist stages."""
+        queues = [asyncio.Queue(maxsize=settings.PIPELINE["queue_size"]) for _ in range(4)]
+        fetch_queue, merge_queue, transform_queue, persist_queue = queues
+        self.queues = dict(zip(["fetch", "merge", "transform", "persist"], queues))
+        stages = [
+            ("fetch", self.fetch_stage, fetch_queue, merge_queue, settings.PIPELINE["fetch_workers"]),
+            ("merge", self.merge_stage, merge_queue, transform_queue, settings.PIPELINE["merge_workers"]),
+            ("transform", self.transform_stage, transform_queue, persist_queue, settings.PIPELINE["transform_workers"]),
+            ("persist", self.persist_stage, persist_queue, None, settings.PIPELINE["persist_workers"]),
+        ]
+        self.writer = DataObjectWriter()
+        fetched = self.start_checkpoints(fetched, to_delete)
+        workers = []
+        for stage, handler, in_queue, out_queue, worker_count in stages:
+            for _ in range(worker_count):
+                workers.append(asyncio.ensure_future(
+                    self.stage_worker(stage, handler, in_queue, out_queue, loop, executor, to_delete)))
+        for unit_index, unit in enumerate(self.get_fetch_units(fetched)):
+            self.units[unit_index] = self.get_unit_items(unit)
+            self.pending[unit_index] = 1
+            await fetch_queue.put((unit_index, unit))
+        for queue in queues:
+            await queue.join()
+        for worker in workers:
+            worker.cancel()
+        for result in await asyncio.gather(*workers, return_exceptions=True):
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+                self.record_error("Error in pipeline worker: {}".format(result))
         try:
-            if self.is_exportable(data):
-                merged, merged_object_type = await loop.run_in_executor(executor, run_merger, self.merger, self.object_type, data)
-                await loop.run_in_executor(executor, run_transformer, merged_object_type, merged)
-            else:
-                to_delete.append(data.get("uri", data.get("archivesspace_uri")))
+            await loop.run_in_executor(executor, self.writer.flush)
         except Exception as e:
-            print(e)
-            FetchRunError.objects.create(run=self.current_run, message=str(e))
+            self.record_error("Error saving data: {}".format(e))
+        self.record_write_failures()
+        self.update_checkpoint(self.completed, self.last_item, to_delete)
+        self.current_run.metrics["saved"] = self.current_run.checkpoint["saved"]
+        self.current_run.metrics["unchanged"] = self.current_run.checkpoint["unchanged"]
+
+    async def stage_worker(self, stage, handler, in_queue, out_queue, loop, executor, to_delete):
+        """Handles items from one queue and puts the results on the next, tracking pending items per fetch unit."""
+        metrics = self.stage_metrics[stage]
+        latency = self.latency[stage]
+        while True:
+            unit_index, item = await in_queue.get()
+            metrics["items"] += 1
+            try:
+                start = time.perf_counter()
+                try:
+                    results = await handler(item, loop, executor, to_delete)
+                finally:
+                    elapsed = time.perf_counter() - start
+                    metrics["seconds"] += elapsed
+                    latency.observe(elapsed)
+                metrics["results"] += len(results)
+                start = time.perf_counter()
+                for result in results:
+                    self.pending[unit_index] += 1
+                    await out_queue.put((unit_index, result))
+                metrics["blocked"] += time.perf_counter() - start
+            except Exception as e:
+                metrics["errors"] += 1
+                self.record_error(str(e))
+            finally:
+                self.pending[unit_index] -= 1
+                if not self.pending[unit_index]:
+                    try:
+                        await self.complete_unit(unit_index, loop, executor, to_delete)
+                    except Exception as e:
+                        self.record_error("Error saving checkpoint: {}".format(e))
+                in_queue.task_done()
+
+    async def fetch_stage(self, unit, loop, executor, to_delete):
+        return await self.fetch_unit(unit)
+
+    async def merge_stage(self, data, loop, executor, to_delete):
+        self.processed += 1
+        if not self.is_exportable(data):
+            self.excluded += 1
+            to_delete.append(data.get("uri", data.get("archivesspace_uri")))
+            return []
+        merged, merged_object_type = await loop.run_in_executor(
+            executor, self.profile, "merge", run_merger, self.merger, self.object_type, data, self.cache)
+        return [(merged_object_type, merged)]
+
+    async def transform_stage(self, merged_data, loop, executor, to_delete):
+        """Transforms merged data, deciding here whether to validate so sampling is shared by all processes."""
+        merged_object_type, merged = merged_data
+        should_validate = sampler.should_validate(merged_object_type)
+        try:
+            if self.profiler and self.profiler.should_profile("transform"):
+                return [await loop.run_in_executor(
+                    executor, self.profiler.runcall, "transform", run_transformer, merged_object_type, merged, should_validate)]
+            return [await loop.run_in_executor(
+                self.transform_executor, run_transformer, merged_object_type, merged, should_validate)]
+        except TransformValidationError:
+            sampler.record_failure(merged_object_type)
+            self.invalid += 1
+            raise
+
+    async def persist_stage(self, transformed_data, loop, executor, to_delete):
+        transformed, content_hash = transformed_data
+        await loop.run_in_executor(executor, self.profile, "persist", self.writer.add, transformed, content_hash)
+        return []
 
     def is_exportable(self, obj):
         """Determines whether the object can be exported.
@@ -142,6 +352,11 @@ class ArchivesSpaceDataFetcher(BaseDataFetcher):
     source = FetchRun.ARCHIVESSPACE
     page_size = 25
 
+    def run_fetch(self):
+        self.resource_counts = Counter()
+        self.indexed_resources = set()
+        return super(ArchivesSpaceDataFetcher, self).run_fetch()
+
     def get_merger(self, object_type):
         MERGERS = {
             "resource": ResourceMerger,
@@ -153,18 +368,34 @@ class ArchivesSpaceDataFetcher(BaseDataFetcher):
         }
         return MERGERS[object_type]
 
+    def instantiate_async_client(self, limit):
+        return instantiate_async_aspace(clients["aspace"], limit=limit)
+
     def get_updated(self):
         params = {"all_ids": True, "modified_since": self.last_run}
         endpoint = self.get_endpoint(self.object_type)
-        return clients["aspace"].client.get(endpoint, params=params).json()
+        return sorted(clients["aspace"].client.get(endpoint, params=params).json())
+
+    def count_updated(self):
+        """Returns the number of objects modified since the last run."""
+        client = instantiate_aspace(settings.ARCHIVESSPACE).client
+        resp = client.get(
+            self.get_endpoint(self.object_type),
+            params={"page": 1, "page_size": 1, "modified_since": self.last_run})
+        resp.raise_for_status()
+        return resp.json()["total"]
+
+    def count_deleted(self):
+        """Returns the number of objects of this type deleted since the last run."""
+        return len(self.filter_deleted(instantiate_aspace(settings.ARCHIVESSPACE).client))
 
     def get_deleted(self):
-        data = []
-        for d in clients["aspace"].client.get_paged(
-                "delete-feed", params={"modified_since": self.last_run}):
-            if self.get_endpoint(self.object_type) in d:
-                data.append(d)
-        return data
+        return self.filter_deleted(clients["aspace"].client)
+
+    def filter_deleted(self, client):
+        """Returns URIs from the delete feed which belong to this fetcher's object type."""
+        endpoint = self.get_endpoint(self.object_type)
+        return [d for d in client.get_paged("delete-feed", params={"modified_since": self.last_run}) if endpoint in d]
 
     def get_endpoint(self, object_type):
         repo_baseurl = "/repositories/{}".format(settings.ARCHIVESSPACE["repo"])
@@ -183,11 +414,77 @@ class ArchivesSpaceDataFetcher(BaseDataFetcher):
             endpoint = "/agents/families"
         return endpoint
 
+    def get_fetch_units(self, fetched):
+        return list_chunks(fetched, self.page_size)
+
+    def get_unit_items(self, unit):
+        return unit
+
+    def get_remaining(self, fetched, checkpoint):
+        """Returns identifiers greater than the last one processed, since identifiers are sorted."""
+        if checkpoint["last_item"] is None:
+            return fetched
+        return [i for i in fetched if i > checkpoint["last_item"]]
+
+    async def fetch_unit(self, id_list):
+        page = await self.get_page(id_list)
+        if self.object_type == "archival_object":
+            await self.index_resource_trees(page)
+        await self.prefetch_cartographer_data(page)
+        return page
+
+    async def prefetch_cartographer_data(self, page):
+        """Caches the Cartographer data needed to merge a page of records, requesting each resource once."""
+        uris = []
+        if self.object_type == "archival_object":
+            uris = [obj["resource"]["ref"] for obj in page]
+        elif self.object_type == "resource":
+            uris = [obj["uri"] for obj in page]
+        if uris:
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(None, CartographerHelper(clients["cartographer"]).find_by_uris, uris)
+            except Exception as e:
+                print("Unable to prefetch Cartographer data: {}".format(e))
+
+    async def index_resource_trees(self, page):
+        """Caches child counts for resources in the page with settings.TREE_INDEX_THRESHOLD updated archival objects."""
+        resource_uris = list(OrderedDict.fromkeys(obj["resource"]["ref"] for obj in page))
+        for obj in page:
+            self.resource_counts[obj["resource"]["ref"]] += 1
+        for resource_uri in resource_uris:
+            if self.resource_counts[resource_uri] >= settings.TREE_INDEX_THRESHOLD and resource_uri not in self.indexed_resources:
+                self.indexed_resources.add(resource_uri)
+                try:
+                    child_counts = await self.get_child_counts(resource_uri)
+                    self.cache.set(("child_counts", resource_uri), child_counts)
+                except Exception as e:
+                    print("Unable to index tree for {}: {}".format(resource_uri, e))
+
+    async def get_child_counts(self, resource_uri):
+        """Returns a dict of archival object URIs in a resource tree mapped to child counts."""
+        root = await self.async_client.get("{}/tree/root".format(resource_uri))
+        child_counts = {}
+        parents = [({}, root["waypoints"])]
+        while parents:
+            waypoints = await asyncio.gather(*[
+                self.async_client.get(
+                    "{}/tree/waypoint".format(resource_uri),
+                    params=dict(offset=offset, **params))
+                for params, waypoint_count in parents
+                for offset in range(waypoint_count)])
+            parents = []
+            for node in [n for waypoint in waypoints for n in waypoint]:
+                child_counts[node["uri"]] = node["child_count"]
+                if node["child_count"] > 0:
+                    parents.append(({"parent_node": node["uri"]}, node["waypoints"]))
+        return child_counts
+
     async def get_page(self, id_list):
         params = {
             "id_set": id_list,
             "resolve": ["ancestors", "ancestors::linked_agents", "instances::top_container", "linked_agents", "subjects"]}
-        return clients["aspace"].client.get(self.get_endpoint(self.object_type), params=params).json()
+        return await self.async_client.get(self.get_endpoint(self.object_type), params=params)
 
 
 class CartographerDataFetcher(BaseDataFetcher):
@@ -198,6 +495,9 @@ class CartographerDataFetcher(BaseDataFetcher):
     def get_merger(self, object_type):
         return ArrangementMapMerger
 
+    def instantiate_async_client(self, limit):
+        return instantiate_async_electronbond(limit=limit)
+
     def get_updated(self):
         data = []
         for obj in clients["cartographer"].get(
@@ -205,6 +505,20 @@ class CartographerDataFetcher(BaseDataFetcher):
             data.append("{}{}/".format(self.base_endpoint, obj.get("id")))
         return data
 
+    def count_updated(self):
+        return self.count_changes(self.base_endpoint, {"modified_since": self.last_run})
+
+    def count_deleted(self):
+        return self.count_changes("/api/delete-feed/", {"deleted_since": self.last_run})
+
+    def count_changes(self, endpoint, params):
+        """Returns the number of objects changed since the last run, without a health check."""
+        client = ElectronBond(baseurl=settings.CARTOGRAPHER["baseurl"])
+        instantiate_session(client.session)
+        resp = client.get(endpoint, params=params)
+        resp.raise_for_status()
+        return resp.json()["count"]
+
     def get_deleted(self):
         data = []
         for deleted_ref in clients["cartographer"].get(
@@ -213,5 +527,11 @@ class CartographerDataFetcher(BaseDataFetcher):
                 data.append(deleted_ref.get('archivesspace_uri'))
         return data
 
+    def get_fetch_units(self, fetched):
+        return fetched
+
+    async def fetch_unit(self, obj_ref):
+        return [await self.get_item(obj_ref)]
+
     async def get_item(self, obj_ref):
-        return clients["cartographer"].get(obj_ref).json()
+        return await self.async_client.get(obj_ref)
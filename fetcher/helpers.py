@@ -1,11 +1,23 @@
+import asyncio
+import threading
+from datetime import timedelta
+from functools import lru_cache, partial
+
+import aiohttp
 import requests
 import shortuuid
 from asnake.aspace import ASpace
 from django.core.mail import send_mail
+from django.db import connection
+from django.utils import timezone
 from electronbonder.client import ElectronBond
 from pisces import settings
+from requests.adapters import HTTPAdapter
+from transformer.models import IdentifierMapping
+from urllib3.util.retry import Retry
+from yarl import URL
 
-from .models import FetchRun, FetchRunError
+from .models import DeleteRequest, FetchRun, FetchRunError
 
 
 def list_chunks(lst, n):
@@ -18,6 +30,18 @@ def list_chunks(lst, n):
         yield lst[i:i + n]
 
 
+def close_thread_connections(executor, workers):
+    """Closes the database connection of each of an executor's worker threads."""
+    barrier = threading.Barrier(workers)
+
+    def close():
+        connection.close()
+        barrier.wait()
+
+    for future in [executor.submit(close) for _ in range(workers)]:
+        future.result()
+
+
 def last_run_time(source, object_status, object_type):
     """Returns a date object for a successful fetch.
 
@@ -29,19 +53,93 @@ def last_run_time(source, object_status, object_type):
     Returns:
         int: A UTC timestamp coerced to an integer.
     """
-    if FetchRun.objects.filter(
-            status=FetchRun.FINISHED,
-            source=source,
-            object_type=object_type,
-            object_status=object_status).exists():
-        return int(FetchRun.objects.filter(
-            status=FetchRun.FINISHED,
-            source=source,
-            object_type=object_type,
-            object_status=object_status
-        ).order_by("-start_time")[0].start_time.timestamp())
-    else:
-        return 0
+    start_time = FetchRun.objects.filter(
+        status=FetchRun.FINISHED,
+        source=source,
+        object_type=object_type,
+        object_status=object_status,
+        parent__isnull=True).order_by("-start_time").values_list("start_time", flat=True).first()
+    return int(start_time.timestamp()) if start_time else 0
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """An HTTPAdapter which applies a default timeout to every request."""
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def instantiate_session(session=None, config=None, method_whitelist=Retry.DEFAULT_METHOD_WHITELIST):
+    """Configures a requests session with pooled connections, retries and a default timeout.
+
+    Args:
+        session (requests.Session): an optional session to configure.
+        config (dict): an optional config dict
+        method_whitelist (set): HTTP methods which are retried
+    """
+    config = config if config else settings.HTTP
+    session = session if session else requests.Session()
+    retry = Retry(
+        total=config["retries"],
+        backoff_factor=config["backoff_factor"],
+        status_forcelist=RETRY_STATUSES,
+        method_whitelist=method_whitelist,
+        raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=config["pool_size"],
+        pool_maxsize=config["pool_size"],
+        max_retries=retry,
+        timeout=config["timeout"])
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not hasattr(session, "transfer_stats"):
+        session.transfer_stats = TransferStats()
+        session.hooks["response"].append(session.transfer_stats.record)
+    return session
+
+
+def instantiate_index_session(config=None):
+    """Configures a session for index delete requests, which can safely be retried."""
+    return instantiate_session(config=config, method_whitelist=Retry.DEFAULT_METHOD_WHITELIST | {"POST"})
+
+
+class TransferStats:
+    """Counts bytes received and retries made by a requests session."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def record(self, response, *args, **kwargs):
+        retries = getattr(response.raw, "retries", None)
+        with self.lock:
+            self.bytes += len(response.content)
+            self.retries += len(retries.history) if retries else 0
+
+
+def session_stats(session):
+    """Returns request, connection, reuse, byte and retry counts for a requests session."""
+    stats = {"requests": 0, "connections": 0}
+    for adapter in set(session.adapters.values()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            stats["requests"] += pool.num_requests
+            stats["connections"] += pool.num_connections
+    stats["reused"] = stats["requests"] - stats["connections"]
+    transfer_stats = getattr(session, "transfer_stats", None)
+    stats["bytes"] = transfer_stats.bytes if transfer_stats else 0
+    stats["retries"] = transfer_stats.retries if transfer_stats else 0
+    return stats
 
 
 def instantiate_aspace(self, config=None):
@@ -58,6 +156,7 @@ def instantiate_aspace(self, config=None):
         baseurl=config['baseurl'],
         username=config['username'],
         password=config['password'])
+    instantiate_session(aspace.client.session)
     return aspace
 
 
@@ -69,6 +168,7 @@ def instantiate_electronbond(self, config=None):
     """
     config = config if config else settings.CARTOGRAPHER
     client = ElectronBond(baseurl=config['baseurl'])
+    instantiate_session(client.session)
     try:
         resp = client.get(config['health_check_path'])
         resp.raise_for_status()
@@ -78,6 +178,113 @@ def instantiate_electronbond(self, config=None):
             "Cartographer is not available: {}".format(e))
 
 
+def encode_params(params):
+    """Encodes request parameters as ArchivesSnake does, with lists as repeated `key[]` parameters.
+
+    Args:
+        params (dict): request parameters.
+
+    Returns:
+        list: a list of (key, value) tuples.
+    """
+    encoded = []
+    for key, value in (params or {}).items():
+        if isinstance(value, (list, tuple)):
+            encoded += [("{}[]".format(key), str(v)) for v in value]
+        else:
+            encoded.append((key, str(value)))
+    return encoded
+
+
+class AsyncClient:
+    """A non-blocking HTTP client with a shared session, used as an asynchronous context manager.
+
+    Args:
+        baseurl (str): the base URL against which paths are resolved.
+        headers (dict): optional headers sent with every request.
+        limit (int): maximum number of simultaneous connections.
+        config (dict): an optional config dict
+    """
+
+    def __init__(self, baseurl, headers=None, limit=100, config=None):
+        self.baseurl = baseurl.rstrip("/")
+        self.headers = headers if headers else {}
+        self.limit = limit
+        self.config = config if config else settings.HTTP
+        self.session = None
+        self.stats = {"requests": 0, "connections": 0, "reused": 0, "retries": 0, "bytes": 0}
+
+    async def __aenter__(self):
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.count("connections"))
+        trace_config.on_connection_reuseconn.append(self.count("reused"))
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(
+                limit=self.limit,
+                keepalive_timeout=self.config["keepalive_timeout"]),
+            timeout=aiohttp.ClientTimeout(total=self.config["timeout"]),
+            trace_configs=[trace_config])
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    def count(self, key):
+        async def on_event(session, context, params):
+            self.stats[key] += 1
+        return on_event
+
+    def build_url(self, path, params=None):
+        """Returns the URL of a path, with parameters encoded in its query string."""
+        return URL("{}/{}".format(self.baseurl, path.lstrip("/"))).with_query(encode_params(params))
+
+    async def get(self, path, params=None):
+        """Makes a GET request and returns the decoded JSON response, counting requests and bytes received."""
+        url = self.build_url(path, params)
+        for attempt in range(self.config["retries"] + 1):
+            retryable = attempt < self.config["retries"]
+            self.stats["requests"] += 1
+            try:
+                async with self.session.get(url) as resp:
+                    if not (retryable and resp.status in RETRY_STATUSES):
+                        resp.raise_for_status()
+                        self.stats["bytes"] += len(await resp.read())
+                        return await resp.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not retryable:
+                    raise
+            self.stats["retries"] += 1
+            await asyncio.sleep(self.config["backoff_factor"] * (2 ** attempt))
+
+
+def instantiate_async_aspace(aspace, limit=100, config=None):
+    """Returns an AsyncClient for ArchivesSpace which reuses an ASpace object's session token.
+
+    Args:
+        aspace (ASpace): an authenticated ASpace object.
+        limit (int): maximum number of simultaneous connections.
+        config (dict): optional config dict
+    """
+    config = config if config else settings.ARCHIVESSPACE
+    headers = {
+        "Accept": "application/json",
+        "X-ArchivesSpace-Session": aspace.client.session.headers.get("X-ArchivesSpace-Session", "")}
+    return AsyncClient(config["baseurl"], headers=headers, limit=limit)
+
+
+def instantiate_async_electronbond(limit=100, config=None):
+    """Returns an AsyncClient for Cartographer.
+
+    Args:
+        limit (int): maximum number of simultaneous connections.
+        config (dict): optional config dict
+    """
+    config = config if config else settings.CARTOGRAPHER
+    return AsyncClient(config["baseurl"], headers={"Accept": "application/json"}, limit=limit)
+
+
+@lru_cache(maxsize=settings.IDENTIFIER_CACHE_SIZE)
 def identifier_from_uri(uri):
     """Creates a short UUID.
 
@@ -93,30 +300,134 @@ def identifier_from_uri(uri):
     return shortuuid.uuid(name=uri)
 
 
-async def handle_deleted_uris(uri_list, source, object_type, current_run):
-    """Delivers POST request to indexing service with list of ids to be deleted."""
-    updated = None
-    es_ids = [identifier_from_uri(uri) for uri in list(set(uri_list))]
-    if es_ids:
+def identifiers_from_uris(uris):
+    """Returns a dict of URIs mapped to identifiers, read from IdentifierMapping where recorded and computed otherwise."""
+    identifiers = dict(IdentifierMapping.objects.filter(uri__in=uris).values_list("uri", "es_id"))
+    for uri in uris:
+        if uri not in identifiers:
+            identifiers[uri] = identifier_from_uri(uri)
+    return identifiers
+
+
+async def handle_deleted_uris(uri_list, source, object_type, current_run, session=None, record_error=None, executor=None):
+    """Sends ids to be deleted to the indexing service in chunks, saving undelivered chunks as DeleteRequests."""
+    loop = asyncio.get_event_loop()
+    deleted = []
+    identifiers = await loop.run_in_executor(executor, identifiers_from_uris, list(set(uri_list)))
+    for chunk in list_chunks(list(identifiers.values()), settings.INDEX_DELETE_CHUNK_SIZE):
         try:
-            resp = requests.post(settings.INDEX_DELETE_URL, json={"identifiers": es_ids})
-            resp.raise_for_status()
-            updated = es_ids
-        except requests.exceptions.HTTPError:
-            if current_run:
-                FetchRunError.objects.create(
-                    run=current_run,
-                    message=resp.json()["detail"])
+            await loop.run_in_executor(executor, send_delete_request, chunk, session)
+            deleted += chunk
         except Exception as e:
-            raise Exception("Error sending delete request: {}".format(e))
-    return updated
+            await loop.run_in_executor(executor, partial(
+                DeleteRequest.objects.create, run=current_run, identifiers=chunk, message=str(e)))
+            if record_error:
+                record_error(str(e))
+            elif current_run:
+                await loop.run_in_executor(executor, partial(FetchRunError.objects.create, run=current_run, message=str(e)))
+    return deleted
+
+
+def send_delete_request(identifiers, session=None):
+    """Sends a list of ids to be deleted to the indexing service."""
+    try:
+        resp = (session if session else requests).post(settings.INDEX_DELETE_URL, json={"identifiers": identifiers})
+    except Exception as e:
+        raise Exception("Error sending delete request: {}".format(e))
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        try:
+            message = resp.json()["detail"]
+        except Exception:
+            message = str(e)
+        raise Exception(message)
+
+
+def replay_delete_requests(session=None):
+    """Resends DeleteRequests which are due for another attempt, returning the number delivered."""
+    delivered = 0
+    now = timezone.now()
+    for delete_request in DeleteRequest.objects.filter(
+            attempts__lt=settings.INDEX_DELETE_MAX_ATTEMPTS).order_by("datetime"):
+        backoff = timedelta(seconds=settings.INDEX_DELETE_BACKOFF * 2 ** (delete_request.attempts - 1))
+        if delete_request.datetime + backoff > now:
+            continue
+        try:
+            send_delete_request(delete_request.identifiers, session)
+            delete_request.delete()
+            delivered += 1
+        except Exception as e:
+            delete_request.message = str(e)
+            delete_request.attempts += 1
+            delete_request.datetime = timezone.now()
+            delete_request.save()
+    return delivered
+
+
+def drop_delete_requests(identifiers):
+    """Removes identifiers of objects which have been saved again from pending DeleteRequests."""
+    identifiers = set(identifiers)
+    for delete_request in DeleteRequest.objects.all():
+        remaining = [i for i in delete_request.identifiers if i not in identifiers]
+        if not remaining:
+            delete_request.delete()
+        elif len(remaining) < len(delete_request.identifiers):
+            delete_request.identifiers = remaining
+            delete_request.save()
+
+
+class DeleteNotifier:
+    """Sends URIs of objects to be deleted to the index in chunks as they are found."""
+
+    def __init__(self, source, object_type, current_run, session=None, record_error=None, executor=None):
+        self.source = source
+        self.object_type = object_type
+        self.current_run = current_run
+        self.session = session
+        self.record_error = record_error
+        self.executor = executor
+        self.buffer = []
+        self.sending = {}
+        self.deleted = []
+
+    def __iter__(self):
+        return iter(self.buffer + [uri for chunk in self.sending.values() for uri in chunk])
+
+    def append(self, uri):
+        self.buffer.append(uri)
+        if len(self.buffer) >= settings.INDEX_DELETE_CHUNK_SIZE:
+            self.send()
+
+    def extend(self, uris):
+        for uri in uris:
+            self.append(uri)
+
+    def send(self):
+        chunk, self.buffer = self.buffer, []
+        task = asyncio.ensure_future(handle_deleted_uris(
+            chunk, self.source, self.object_type, self.current_run, self.session, self.record_error, self.executor))
+        self.sending[task] = chunk
+        task.add_done_callback(self.sent)
+
+    def sent(self, task):
+        del self.sending[task]
+        if not task.cancelled() and not task.exception():
+            self.deleted += task.result()
+
+    async def flush(self):
+        if self.buffer:
+            self.send()
+        await asyncio.gather(*self.sending, return_exceptions=True)
+        return self.deleted
 
 
 def send_error_notification(fetch_run):
     """Send email with errors encountered during a fetch run."""
     try:
         errors = ""
-        err_str = "errors" if fetch_run.error_count > 1 else "error"
+        error_count = fetch_run.error_count
+        err_str = "errors" if error_count > 1 else "error"
         object_type = fetch_run.get_object_type_display()
         object_status = fetch_run.get_object_status_display()
         source = [s[1] for s in FetchRun.SOURCE_CHOICES if s[0] == int(fetch_run.source)][0]
@@ -124,7 +435,7 @@ def send_error_notification(fetch_run):
             errors += "{}\n".format(err.message)
         send_mail(
             "{} {} processing {} {} objects from {}".format(
-                fetch_run.error_count, err_str, object_status, object_type, source),
+                error_count, err_str, object_status, object_type, source),
             "The following errors were encountered while processing {} {} objects from {}:\n\n{}".format(
                 object_status, object_type, source, errors),
             "alerts@rockarch.org",
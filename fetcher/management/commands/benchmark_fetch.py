@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from fetcher.benchmarks import benchmark_fetch, compare_results, print_results
+from fetcher.cron import FETCH_JOBS
+
+
+class Command(BaseCommand):
+    help = "Runs fetch jobs end to end against recorded responses and reports throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--object-type", action="append", dest="object_types", help="Only run jobs for this object type.")
+        parser.add_argument("--object-status", choices=["updated", "deleted"], help="Only run jobs for this object status.")
+        parser.add_argument("--iterations", type=int, default=3, help="Number of times to run each job.")
+        parser.add_argument("--latency", type=float, default=0, help="Milliseconds to wait before each response.")
+        parser.add_argument("--output", help="File to write JSON results to.")
+        parser.add_argument("--compare", help="JSON results of an earlier benchmark to compare against.")
+        parser.add_argument("--keepdb", action="store_true", help="Preserve the benchmark database between runs.")
+
+    def handle(self, *args, **options):
+        jobs = FETCH_JOBS
+        if options["object_types"]:
+            jobs = [job for job in jobs if job.object_type in options["object_types"]]
+        if options["object_status"]:
+            jobs = [job for job in jobs if job.object_status == options["object_status"]]
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        try:
+            results = benchmark_fetch(jobs, iterations=options["iterations"], latency=options["latency"] / 1000)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options["keepdb"])
+        changes = None
+        if options["compare"]:
+            with open(options["compare"], "r") as f:
+                changes = compare_results(json.load(f), results)
+        print_results(results, changes)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
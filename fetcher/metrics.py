@@ -0,0 +1,287 @@
+"""Pipeline metrics in the Prometheus text exposition format.
+
+Fetch runs happen in cron and scheduler worker processes rather than the web
+process, so instead of being held in memory, counts and latency histograms
+are kept in each FetchRun's metrics as the run progresses and totalled
+across runs by the database when they are scraped. Totals of runs which are
+deleted are kept as MetricTotals, so counters never go down.
+"""
+
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.contrib.postgres.fields.jsonb import KeyTextTransform, KeyTransform
+from django.db import transaction
+from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models.functions import Cast
+from django.utils import timezone
+from merger.helpers import cartographer_cache
+from pisces import settings
+from transformer.models import DataObject
+
+from .helpers import identifier_from_uri
+from .models import FetchRun, MetricTotal
+
+PIPELINE_STAGES = ("fetch", "merge", "transform", "persist")
+CACHES = ("merge", "cartographer", "identifier")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def bucket_labels(buckets):
+    """Returns the `le` label of each histogram bucket, including +Inf."""
+    return ["{:g}".format(bound) for bound in buckets] + ["+Inf"]
+
+
+class LatencyHistogram:
+    """Counts observations in the buckets in settings.METRICS["buckets"].
+
+    Counts are kept in a dict keyed by the upper bound of each bucket, so
+    they can be saved with a run's metrics. Unlike Prometheus histograms,
+    each bucket only counts observations greater than the bound of the
+    previous bucket; counts are made cumulative when they are rendered.
+
+    Args:
+        counts (dict): bucket counts to update, usually from a run's metrics.
+    """
+
+    def __init__(self, counts, buckets=None):
+        self.buckets = buckets if buckets else settings.METRICS["buckets"]
+        self.labels = bucket_labels(self.buckets)
+        self.counts = counts
+        for label in self.labels:
+            self.counts.setdefault(label, 0)
+
+    def observe(self, value):
+        self.counts[self.labels[bisect_left(self.buckets, value)]] += 1
+
+
+def metrics_value(*keys):
+    """Returns an expression for a number in FetchRun.metrics, at a path of keys."""
+    expression = "metrics"
+    for key in keys[:-1]:
+        expression = KeyTransform(key, expression)
+    return Cast(KeyTextTransform(keys[-1], expression), FloatField())
+
+
+def get_metric_paths():
+    """Returns the paths in FetchRun.metrics of each total, keyed by name."""
+    paths = {"processed": ("processed",), "invalid": ("invalid",)}
+    for stage in PIPELINE_STAGES:
+        for key in ("errors", "seconds", "blocked"):
+            paths["{}_{}".format(stage, key)] = ("stages", stage, key)
+        for index, label in enumerate(bucket_labels(settings.METRICS["buckets"])):
+            paths["{}_bucket_{}".format(stage, index)] = ("stages", stage, "latency", label)
+    for cache in CACHES:
+        for key in ("hits", "misses"):
+            paths["{}_{}".format(cache, key)] = ("caches", cache, key)
+    return paths
+
+
+def total_runs(runs):
+    """Totals counters and histograms of runs, by source and object type.
+
+    Parent runs of sharded fetches are left out, since the records they
+    fetched are counted by their shards.
+
+    Args:
+        runs (QuerySet): the FetchRuns to total.
+
+    Returns:
+        list: dicts with the source, object type, number of runs and totals
+        keyed by names such as `merge_errors` or `fetch_bucket_0`.
+    """
+    return list(runs
+                .exclude(metrics__has_key="shards")
+                .values("source", "object_type")
+                .annotate(runs=Count("id"), **{name: Sum(metrics_value(*path)) for name, path in get_metric_paths().items()})
+                .order_by("source", "object_type"))
+
+
+def get_run_totals():
+    """Totals counters and histograms across all runs, including deleted runs."""
+    totals = {(row["source"], row["object_type"]): row for row in total_runs(FetchRun.objects.all())}
+    for total in MetricTotal.objects.all():
+        row = totals.setdefault(
+            (total.source, total.object_type),
+            dict(dict.fromkeys(["runs"] + list(get_metric_paths())), source=total.source, object_type=total.object_type))
+        row[total.name] = (row.get(total.name) or 0) + total.value
+    return [totals[key] for key in sorted(totals)]
+
+
+def retire_runs(runs):
+    """Adds the totals of runs which are about to be deleted to MetricTotals, whatever their status.
+
+    Should be called in the same transaction as the runs are deleted.
+    """
+    for row in total_runs(runs):
+        for name, value in row.items():
+            if name in ["source", "object_type"] or not value:
+                continue
+            total, _ = MetricTotal.objects.get_or_create(source=row["source"], object_type=row["object_type"], name=name)
+            MetricTotal.objects.filter(pk=total.pk).update(value=F("value") + value)
+
+
+def delete_runs(runs):
+    """Deletes runs and their shards, first adding their totals to MetricTotals."""
+    run_ids = list(runs.values_list("id", flat=True))
+    with transaction.atomic():
+        retire_runs(FetchRun.objects.filter(Q(pk__in=run_ids) | Q(parent__in=run_ids)))
+        FetchRun.objects.filter(pk__in=run_ids).delete()
+    return run_ids
+
+
+def get_queue_depths():
+    """Returns the queue depths saved at the last checkpoint of each running run."""
+    abandoned = timezone.now() - timedelta(seconds=settings.PIPELINE["shard_timeout"])
+    return list(FetchRun.objects
+                .filter(status=FetchRun.STARTED, last_modified__gt=abandoned)
+                .values("source", "object_type")
+                .annotate(**{stage: Sum(metrics_value("queues", stage)) for stage in PIPELINE_STAGES})
+                .order_by("source", "object_type"))
+
+
+def get_backlog():
+    """Returns the number of DataObjects waiting to be indexed, by object type."""
+    return list(DataObject.objects
+                .filter(indexed=False)
+                .values("object_type")
+                .annotate(count=Count("es_id"))
+                .order_by("object_type"))
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels.items())
+
+
+def format_value(value):
+    value = value or 0
+    return "{:d}".format(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Exposition:
+    """Builds a list of metric families in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, help_text):
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+
+    def sample(self, name, labels, value):
+        self.lines.append("{}{{{}}} {}".format(name, format_labels(labels), format_value(value)))
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def run_labels(row):
+    sources = dict(FetchRun.SOURCE_CHOICES)
+    return {"source": sources.get(int(row["source"]), row["source"]).lower(), "object_type": row["object_type"]}
+
+
+def render_metrics():
+    """Returns pipeline metrics in the Prometheus text exposition format."""
+    rows = [(run_labels(row), row) for row in get_run_totals()]
+    output = Exposition()
+
+    output.family("pisces_fetch_runs_total", "counter", "Fetch runs and shards started.")
+    for labels, row in rows:
+        output.sample("pisces_fetch_runs_total", labels, row["runs"])
+    output.family("pisces_records_processed_total", "counter", "Fetched records passed to the merge stage.")
+    for labels, row in rows:
+        output.sample("pisces_records_processed_total", labels, row["processed"])
+    output.family("pisces_validation_failures_total", "counter", "Transformed records which failed validation.")
+    for labels, row in rows:
+        output.sample("pisces_validation_failures_total", labels, row["invalid"])
+
+    for key, name, help_text in (
+            ("errors", "pisces_stage_errors_total", "Items which raised an error in each pipeline stage."),
+            ("blocked", "pisces_stage_blocked_seconds_total", "Seconds spent waiting for space in the next stage's queue.")):
+        output.family(name, "counter", help_text)
+        for labels, row in rows:
+            for stage in PIPELINE_STAGES:
+                output.sample(name, dict(labels, stage=stage), row["{}_{}".format(stage, key)])
+
+    bounds = bucket_labels(settings.METRICS["buckets"])
+    output.family("pisces_stage_seconds", "histogram", "Seconds taken to handle each item in each pipeline stage.")
+    for labels, row in rows:
+        for stage in PIPELINE_STAGES:
+            count = 0
+            for index, le in enumerate(bounds):
+                count += row["{}_bucket_{}".format(stage, index)] or 0
+                output.sample("pisces_stage_seconds_bucket", dict(labels, stage=stage, le=le), count)
+            output.sample("pisces_stage_seconds_sum", dict(labels, stage=stage), row["{}_seconds".format(stage)])
+            output.sample("pisces_stage_seconds_count", dict(labels, stage=stage), count)
+
+    for key in ("hits", "misses"):
+        name = "pisces_cache_{}_total".format(key)
+        output.family(name, "counter", "Cache {} during fetch runs.".format(key))
+        for labels, row in rows:
+            for cache in CACHES:
+                output.sample(name, dict(labels, cache=cache), row["{}_{}".format(cache, key)])
+    output.family("pisces_cache_hit_ratio", "gauge", "Cache hits as a proportion of lookups, across all fetch runs.")
+    for labels, row in rows:
+        for cache in CACHES:
+            hits, misses = row["{}_hits".format(cache)] or 0, row["{}_misses".format(cache)] or 0
+            output.sample("pisces_cache_hit_ratio", dict(labels, cache=cache), hits / (hits + misses) if hits + misses else 0)
+
+    output.family("pisces_queue_depth", "gauge", "Items waiting in each stage's queue at the last checkpoint of running fetches.")
+    for row in get_queue_depths():
+        for stage in PIPELINE_STAGES:
+            output.sample("pisces_queue_depth", dict(run_labels(row), stage=stage), row[stage])
+
+    output.family("pisces_dataobject_backlog", "gauge", "DataObjects waiting to be indexed.")
+    for row in get_backlog():
+        output.sample("pisces_dataobject_backlog", {"object_type": row["object_type"]}, row["count"])
+    return output.render()
+
+
+class MetricsMixin:
+    """Records per-stage counts, timings, latency histograms and cache stats of fetch runs in FetchRun.metrics."""
+
+    def start_metrics(self):
+        """Sets up stage metrics, continuing from any saved before a run was interrupted."""
+        self.stage_metrics = self.current_run.metrics.get("stages", {})
+        self.latency = {}
+        for stage in PIPELINE_STAGES:
+            metrics = self.stage_metrics.setdefault(stage, {})
+            for key in ["items", "results", "errors", "seconds", "blocked"]:
+                metrics.setdefault(key, 0)
+            self.latency[stage] = LatencyHistogram(metrics.setdefault("latency", {}))
+        for stage in ["list", "delete"]:
+            self.stage_metrics.setdefault(stage, {"seconds": 0})
+        self.excluded = self.current_run.metrics.get("excluded", 0)
+        self.invalid = self.current_run.metrics.get("invalid", 0)
+        saved = self.current_run.metrics.get("caches", {})
+        self.cache_offsets = {
+            name: {key: saved.get(name, {}).get(key, 0) - count for key, count in stats.items()}
+            for name, stats in self.get_cache_stats().items()}
+
+    def get_cache_stats(self):
+        """Returns hits and misses of the caches used by the run, including those of other runs in the process."""
+        identifier = identifier_from_uri.cache_info()
+        return {
+            "merge": {"hits": self.cache.hits, "misses": self.cache.misses},
+            "cartographer": {"hits": cartographer_cache.hits, "misses": cartographer_cache.misses},
+            "identifier": {"hits": identifier.hits, "misses": identifier.misses},
+        }
+
+    def update_metrics(self):
+        """Copies record counts, stage metrics, cache and connection stats to the run's metrics."""
+        self.current_run.metrics.update(
+            processed=self.processed,
+            merged=self.stage_metrics["merge"]["results"],
+            transformed=self.stage_metrics["transform"]["results"],
+            excluded=self.excluded,
+            invalid=self.invalid,
+            stages=self.stage_metrics,
+            caches={
+                name: {key: count + self.cache_offsets[name][key] for key, count in stats.items()}
+                for name, stats in self.get_cache_stats().items()},
+            queues={stage: queue.qsize() for stage, queue in getattr(self, "queues", {}).items()},
+            connections=self.get_connection_stats())
+
+    def get_connection_stats(self):
+        """Returns request and connection reuse counts for each client used in the run."""
+        return {}
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:20
+
+import django.contrib.postgres.fields.jsonb
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0009_fetchrun_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fetchrun',
+            name='identifiers',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='fetchrun',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='fetchrun',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='fetcher.FetchRun'),
+        ),
+        migrations.AlterField(
+            model_name='fetchrun',
+            name='status',
+            field=models.CharField(choices=[(0, 'Started'), (1, 'Finished'), (2, 'Errored'), (3, 'Queued')], max_length=100),
+        ),
+    ]
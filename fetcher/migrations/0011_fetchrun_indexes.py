@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0010_fetchrun_shards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fetchrun',
+            index=models.Index(condition=models.Q(parent__isnull=True), fields=['source', 'object_type', 'object_status', 'status', '-start_time'], name='fetchrun_last_run_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fetchrun',
+            index=models.Index(condition=models.Q(parent__isnull=True), fields=['source', 'object_type', 'object_status', '-start_time'], name='fetchrun_latest_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0011_fetchrun_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fetchrunerror',
+            name='datetime',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:06
+
+import django.contrib.postgres.fields.jsonb
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0012_fetchrunerror_datetime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeleteRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('identifiers', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('message', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('run', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='fetcher.FetchRun')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:15
+
+import django.contrib.postgres.fields.jsonb
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0013_deleterequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileRequest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datetime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('source', models.CharField(choices=[(0, 'ArchivesSpace'), (1, 'Cartographer')], max_length=100)),
+                ('object_type', models.CharField(choices=[('resource', 'Resource'), ('archival_object', 'Archival Object'), ('subject', 'Subject'), ('agent_person', 'Person'), ('agent_corporate_entity', 'Organization'), ('agent_family', 'Family'), ('arrangement_map_component', 'Arrangement Map Component')], max_length=100)),
+                ('object_status', models.CharField(choices=[('updated', 'Updated'), ('deleted', 'Deleted')], max_length=100)),
+                ('sample_rate', models.PositiveIntegerField(default=1)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='fetchrun',
+            name='profile',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fetcher', '0014_profiling'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[(0, 'ArchivesSpace'), (1, 'Cartographer')], max_length=100)),
+                ('object_type', models.CharField(choices=[('resource', 'Resource'), ('archival_object', 'Archival Object'), ('subject', 'Subject'), ('agent_person', 'Person'), ('agent_corporate_entity', 'Organization'), ('agent_family', 'Family'), ('arrangement_map_component', 'Arrangement Map Component')], max_length=100)),
+                ('name', models.CharField(max_length=255)),
+                ('value', models.FloatField(default=0)),
+            ],
+            options={
+                'unique_together': {('source', 'object_type', 'name')},
+            },
+        ),
+    ]
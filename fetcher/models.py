@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -10,10 +13,12 @@ class FetchRun(models.Model):
     STARTED = 0
     FINISHED = 1
     ERRORED = 2
+    QUEUED = 3
     STATUS_CHOICES = (
         (STARTED, 'Started'),
         (FINISHED, 'Finished'),
         (ERRORED, 'Errored'),
+        (QUEUED, 'Queued'),
     )
     ARCHIVESSPACE = 0
     CARTOGRAPHER = 1
@@ -36,10 +41,28 @@ class FetchRun(models.Model):
     OBJECT_STATUS_CHOICES = (("updated", "Updated"), ("deleted", "Deleted"))
     start_time = models.DateTimeField(auto_now_add=True)
     end_time = models.DateTimeField(blank=True, null=True)
+    last_modified = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=100, choices=STATUS_CHOICES)
     source = models.CharField(max_length=100, choices=SOURCE_CHOICES)
     object_type = models.CharField(max_length=100, choices=OBJECT_TYPE_CHOICES)
     object_status = models.CharField(max_length=100, choices=OBJECT_STATUS_CHOICES)
+    metrics = JSONField(default=dict, blank=True)
+    checkpoint = JSONField(default=dict, blank=True)
+    parent = models.ForeignKey('self', on_delete=models.CASCADE, blank=True, null=True, related_name='shards')
+    identifiers = JSONField(default=list, blank=True)
+    profile = JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['source', 'object_type', 'object_status', 'status', '-start_time'],
+                name='fetchrun_last_run_idx',
+                condition=Q(parent__isnull=True)),
+            models.Index(
+                fields=['source', 'object_type', 'object_status', '-start_time'],
+                name='fetchrun_latest_idx',
+                condition=Q(parent__isnull=True)),
+        ]
 
     @property
     def errors(self):
@@ -47,7 +70,10 @@ class FetchRun(models.Model):
 
     @property
     def error_count(self):
-        return len(FetchRunError.objects.filter(run=self))
+        """Returns the number of errors, using the num_errors annotation if present."""
+        if hasattr(self, "num_errors"):
+            return self.num_errors
+        return FetchRunError.objects.filter(run=self).count()
 
     @property
     def elapsed(self):
@@ -57,9 +83,38 @@ class FetchRun(models.Model):
 
 
 class FetchRunError(models.Model):
-    datetime = models.DateTimeField(auto_now_add=True)
+    datetime = models.DateTimeField(default=timezone.now)
     message = models.TextField(max_length=255)
     run = models.ForeignKey(FetchRun, on_delete=models.CASCADE)
 
     class Meta:
         ordering = ('datetime', )
+
+
+class DeleteRequest(models.Model):
+    """Identifiers which could not be delivered to the index to be deleted, and when delivery was last attempted."""
+    datetime = models.DateTimeField(default=timezone.now)
+    identifiers = JSONField(default=list)
+    message = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=1)
+    run = models.ForeignKey(FetchRun, on_delete=models.SET_NULL, blank=True, null=True)
+
+
+class ProfileRequest(models.Model):
+    """A request to profile the next run of a fetch job."""
+    datetime = models.DateTimeField(default=timezone.now)
+    source = models.CharField(max_length=100, choices=FetchRun.SOURCE_CHOICES)
+    object_type = models.CharField(max_length=100, choices=FetchRun.OBJECT_TYPE_CHOICES)
+    object_status = models.CharField(max_length=100, choices=FetchRun.OBJECT_STATUS_CHOICES)
+    sample_rate = models.PositiveIntegerField(default=1)
+
+
+class MetricTotal(models.Model):
+    """A pipeline metric totalled across FetchRuns which have been deleted."""
+    source = models.CharField(max_length=100, choices=FetchRun.SOURCE_CHOICES)
+    object_type = models.CharField(max_length=100, choices=FetchRun.OBJECT_TYPE_CHOICES)
+    name = models.CharField(max_length=255)
+    value = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ("source", "object_type", "name")
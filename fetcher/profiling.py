@@ -0,0 +1,101 @@
+import cProfile
+import pstats
+import threading
+from collections import Counter
+
+from django.db import transaction
+from pisces import settings
+
+from .models import ProfileRequest
+
+
+def claim_profile_request(source, object_type, object_status):
+    """Claims and deletes the oldest ProfileRequest for a fetch job, returning its sample rate."""
+    with transaction.atomic():
+        profile_request = ProfileRequest.objects.select_for_update(skip_locked=True).filter(
+            source=source,
+            object_type=object_type,
+            object_status=object_status).order_by("datetime").first()
+        if profile_request:
+            profile_request.delete()
+            return profile_request.sample_rate
+        return None
+
+
+class RunProfiler:
+    """Profiles a sample of the records handled by a fetch run, by stage.
+
+    cProfile only profiles the thread it is enabled in, so each sampled call
+    is profiled in the thread which makes it, and the stats for each stage are
+    combined. With a sample rate of 1 every call is profiled, otherwise one
+    in every sample_rate calls to each stage.
+
+    Args:
+        sample_rate (int): profile one in every sample_rate calls.
+    """
+
+    def __init__(self, sample_rate=1):
+        self.sample_rate = max(int(sample_rate), 1)
+        self.seen = Counter()
+        self.sampled = Counter()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def should_profile(self, stage):
+        with self.lock:
+            self.seen[stage] += 1
+            return (self.seen[stage] - 1) % self.sample_rate == 0
+
+    def runcall(self, stage, func, *args):
+        """Calls func, adding its profile to the stats for a stage."""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with self.lock:
+                self.sampled[stage] += 1
+                if stage in self.stats:
+                    self.stats[stage].add(profile)
+                else:
+                    self.stats[stage] = pstats.Stats(profile)
+
+    def summary(self, limit=None):
+        """Returns the most expensive functions in each stage.
+
+        Returns:
+            dict: stages mapped to the number of calls sampled, total
+            function calls, seconds, and the functions with the highest
+            cumulative or internal time.
+        """
+        limit = limit if limit else settings.PROFILING["functions"]
+        with self.lock:
+            return {
+                stage: dict(
+                    summarize_stats(stats, limit),
+                    sampled=self.sampled[stage],
+                    seen=max(self.seen[stage], self.sampled[stage]))
+                for stage, stats in self.stats.items()}
+
+
+def summarize_stats(stats, limit):
+    """Returns a JSON serializable summary of a pstats.Stats object."""
+    stats.strip_dirs()
+    functions = [
+        {
+            "function": pstats.func_std_string(func),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "tottime": tottime,
+            "cumtime": cumtime,
+        }
+        for func, (primitive_calls, calls, tottime, cumtime, _) in stats.stats.items()]
+    top = sorted(functions, key=lambda f: -f["cumtime"])[:limit]
+    top += [f for f in sorted(functions, key=lambda f: -f["tottime"])[:limit] if f not in top]
+    return {"calls": stats.total_calls, "seconds": stats.total_tt, "functions": top}
+
+
+def sort_profile(profile, sort="cumtime", limit=None):
+    """Returns a stored profile with each stage's functions sorted and limited."""
+    return {
+        stage: dict(summary, functions=sorted(summary["functions"], key=lambda f: -f[sort])[:limit])
+        for stage, summary in profile.items()}
@@ -0,0 +1,127 @@
+import asyncio
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.db import connections
+from django.utils import timezone
+from pisces import settings
+
+from .models import FetchRun
+
+
+def run_job(job):
+    """Runs a fetch job in a worker process."""
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    try:
+        job().do()
+    except Exception as e:
+        print("Error running {}: {}".format(job.code, e))
+
+
+class Scheduler:
+    """Runs fetch jobs in order of priority, several at a time.
+
+    Each job's priority is its response ratio:
+
+        (time since last run or last empty probe + estimated cost) / estimated cost
+
+    Cheap jobs therefore run soon after their data becomes stale, while
+    expensive jobs are run once they have waited long enough. Estimated cost is the
+    duration of the job's last finished run, scaled by the number of
+    identifiers still pending from an interrupted run, if any.
+
+    Up to settings.SCHEDULER["workers"] jobs run at the same time, each in
+    its own process, so a long archival object run does not hold up updates
+    to other object types.
+
+    Args:
+        jobs (list): fetch job classes, with fetcher, object_status and
+            object_type attributes and a do method.
+        workers (int): number of jobs to run at the same time.
+    """
+
+    def __init__(self, jobs, workers=None):
+        self.jobs = jobs
+        self.workers = workers if workers else settings.SCHEDULER["workers"]
+
+    def get_queue(self):
+        """Returns the state of every job, highest priority first."""
+        return sorted(
+            [self.get_job_state(job) for job in self.jobs],
+            key=lambda state: (state["running"], -state["priority"]))
+
+    def get_job_state(self, job):
+        now = timezone.now()
+        runs = FetchRun.objects.filter(
+            source=job.fetcher.source,
+            object_type=job.object_type,
+            object_status=job.object_status,
+            parent__isnull=True)
+        last_finished = runs.filter(status=FetchRun.FINISHED).order_by("-start_time").first()
+        latest = runs.order_by("-start_time").first()
+        abandoned = now - timedelta(seconds=settings.PIPELINE["shard_timeout"])
+        running = bool(latest and int(latest.status) == FetchRun.STARTED and latest.last_modified > abandoned)
+        pending = None
+        if latest and int(latest.status) != FetchRun.FINISHED and latest.checkpoint:
+            pending = latest.checkpoint["total"] - latest.checkpoint["completed"]
+        cost = self.estimate_cost(last_finished, pending)
+        staleness = now.timestamp()
+        if last_finished:
+            checked = max(last_finished.start_time.timestamp(), last_finished.metrics.get("last_probe", 0))
+            staleness = now.timestamp() - checked
+        return {
+            "code": job.code,
+            "source": job.fetcher.source,
+            "object_type": job.object_type,
+            "object_status": job.object_status,
+            "last_run": last_finished.start_time if last_finished else None,
+            "staleness": staleness,
+            "pending": pending,
+            "estimated_cost": cost,
+            "priority": (staleness + cost) / cost,
+            "running": running,
+        }
+
+    def estimate_cost(self, last_finished, pending=None):
+        """Returns the estimated number of seconds a job will take."""
+        if not (last_finished and last_finished.end_time):
+            return max(settings.SCHEDULER["default_cost"], 1)
+        cost = last_finished.elapsed.total_seconds()
+        processed = last_finished.metrics.get("processed")
+        if pending is not None and processed:
+            cost = cost / processed * pending
+        return max(cost, 1)
+
+    def next_job(self, jobs):
+        """Returns the highest priority job which is not already running."""
+        queue = [state for state in self.get_queue() if not state["running"]]
+        codes = {job.code: job for job in jobs}
+        for state in queue:
+            if state["code"] in codes:
+                return codes[state["code"]]
+        return None
+
+    def run(self):
+        """Runs every job once, highest priority first.
+
+        Priorities are recalculated each time a worker becomes free. Jobs
+        which are already running elsewhere are skipped.
+        """
+        waiting = list(self.jobs)
+        running = {}
+        while waiting or running:
+            for process in [p for p in running if not p.is_alive()]:
+                process.join()
+                del running[process]
+            while waiting and len(running) < self.workers:
+                job = self.next_job(waiting)
+                if not job:
+                    waiting = []
+                    break
+                waiting.remove(job)
+                connections.close_all()
+                process = multiprocessing.Process(target=run_job, args=(job,))
+                process.start()
+                running[process] = job
+            time.sleep(settings.SCHEDULER["poll_interval"])
@@ -13,11 +13,13 @@ class FetchRunSerializer(serializers.HyperlinkedModelSerializer):
     errors = FetchRunErrorSerializer(source='fetchrunerror_set', many=True)
     source = serializers.SerializerMethodField()
     status = serializers.SerializerMethodField()
+    throughput = serializers.SerializerMethodField()
 
     class Meta:
         model = FetchRun
         fields = ('url', 'status', 'source', 'object_type', 'object_status',
-                  'error_count', 'errors', 'start_time', 'end_time', 'elapsed')
+                  'error_count', 'errors', 'start_time', 'end_time', 'elapsed',
+                  'throughput', 'metrics', 'checkpoint', 'parent')
 
     def get_source(self, obj):
         return obj.SOURCE_CHOICES[int(obj.source)][1]
@@ -25,6 +27,11 @@ class FetchRunSerializer(serializers.HyperlinkedModelSerializer):
     def get_status(self, obj):
         return obj.STATUS_CHOICES[int(obj.status)][1]
 
+    def get_throughput(self, obj):
+        """Returns the number of records processed per second."""
+        seconds = obj.elapsed.total_seconds() if obj.elapsed else 0
+        return obj.metrics.get("processed", 0) / seconds if seconds else None
+
 
 class FetchRunListSerializer(serializers.HyperlinkedModelSerializer):
     source = serializers.SerializerMethodField()
@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from pisces import settings
+
+from .helpers import list_chunks
+from .models import FetchRun
+
+
+def claim_shard(**filters):
+    """Claims a queued or abandoned shard, skipping shards locked by other workers."""
+    abandoned = timezone.now() - timedelta(seconds=settings.PIPELINE["shard_timeout"])
+    with transaction.atomic():
+        shard = FetchRun.objects.select_for_update(skip_locked=True).filter(
+            Q(status=FetchRun.QUEUED) | Q(status=FetchRun.STARTED, last_modified__lt=abandoned),
+            parent__isnull=False,
+            **filters).order_by("-status", "id").first()
+        if shard:
+            shard.status = FetchRun.STARTED
+            shard.save()
+        return shard
+
+
+def finish_parent_run(parent):
+    """Finishes a parent FetchRun once none of its shards are queued or started."""
+    with transaction.atomic():
+        parent = FetchRun.objects.select_for_update().get(pk=parent.pk)
+        statuses = [int(s) for s in parent.shards.values_list("status", flat=True)]
+        if int(parent.status) != FetchRun.STARTED or FetchRun.QUEUED in statuses or FetchRun.STARTED in statuses:
+            return False
+        parent.status = FetchRun.ERRORED if FetchRun.ERRORED in statuses else FetchRun.FINISHED
+        parent.end_time = timezone.now()
+        parent.metrics["processed"] = sum(shard.metrics.get("processed", 0) for shard in parent.shards.all())
+        parent.save()
+        return True
+
+
+class ShardingMixin:
+    """Splits large runs of updated objects into shards which workers claim.
+
+    Shards are queued child runs holding their identifiers. A started shard
+    which has not been saved for settings.PIPELINE["shard_timeout"] seconds is
+    claimed again and resumes from its checkpoint. The parent run is finished
+    by whichever worker finishes its last shard, and is errored if any shard
+    errored.
+    """
+
+    def fetch_shard(self, shard):
+        """Processes the identifiers in a shard claimed with claim_shard."""
+        self.object_status = shard.object_status
+        self.object_type = shard.object_type
+        self.last_run = None
+        self.current_run = shard
+        return self.run_fetch()
+
+    def get_fetched(self):
+        """Returns the identifiers to process, or a shard's identifiers."""
+        if self.current_run.parent_id:
+            return self.current_run.identifiers
+        return getattr(self, "get_{}".format(self.object_status))()
+
+    def should_shard(self, fetched):
+        """Determines whether a new, unresumed run of updated objects is split into shards."""
+        shard_size = settings.PIPELINE["shard_size"]
+        if self.object_status != "updated" or self.current_run.parent_id or self.current_run.checkpoint:
+            return False
+        return bool(shard_size) and len(fetched) > shard_size
+
+    def create_shards(self, fetched):
+        """Splits identifiers into queued child runs, which workers can claim."""
+        shards = [
+            FetchRun(
+                status=FetchRun.QUEUED,
+                source=self.source,
+                object_type=self.object_type,
+                object_status=self.object_status,
+                parent=self.current_run,
+                identifiers=identifiers)
+            for identifiers in list_chunks(fetched, settings.PIPELINE["shard_size"])]
+        FetchRun.objects.bulk_create(shards)
+        self.current_run.metrics["shards"] = len(shards)
+        self.current_run.save()
+
+    def get_sharded_run(self):
+        """Returns the latest run of this fetch if it is sharded and still in progress."""
+        latest = FetchRun.objects.filter(
+            source=self.source,
+            object_type=self.object_type,
+            object_status=self.object_status,
+            parent__isnull=True).order_by("-start_time").first()
+        if latest and int(latest.status) == FetchRun.STARTED and latest.metrics.get("shards"):
+            return latest
+        return None
+
+    def process_shards(self, parent):
+        """Claims and processes shards of a parent run until none are left, returning the number processed."""
+        processed = 0
+        while True:
+            shard = claim_shard(parent=parent)
+            if not shard:
+                break
+            try:
+                processed += self.__class__().fetch_shard(shard)
+            except Exception as e:
+                print("Error processing shard {}: {}".format(shard.pk, e))
+        finish_parent_run(parent)
+        return processed
@@ -1,18 +1,28 @@
 import asyncio
 import random
+from collections import Counter
+from concurrent.futures import Executor, Future
 from datetime import datetime
 from unittest.mock import Mock, patch
 
 import pytz
+import requests
 import vcr
 from django.core import mail
 from django.test import TestCase
+from django.urls import reverse
 from django.utils import timezone
+from merger.helpers import LRUCache
 from requests import Response
 from requests.exceptions import HTTPError
 from rest_framework.test import APIRequestFactory
+from transformer.models import DataObject
+from transformer.validators import ValidationSampler
 
-from .cron import (CleanUpCompleted, DeletedArchivesSpaceArchivalObjects,
+from .benchmarks import (ReplayServer, compare_results, load_cassettes,
+                         percentile)
+from .cron import (FETCH_JOBS, CleanUpCompleted,
+                   DeletedArchivesSpaceArchivalObjects,
                    DeletedArchivesSpaceFamilies,
                    DeletedArchivesSpaceOrganizations,
                    DeletedArchivesSpacePeople, DeletedArchivesSpaceResources,
@@ -24,9 +34,15 @@ from .cron import (CleanUpCompleted, DeletedArchivesSpaceArchivalObjects,
                    UpdatedArchivesSpaceSubjects,
                    UpdatedCartographerArrangementMapComponents)
 from .fetchers import ArchivesSpaceDataFetcher, CartographerDataFetcher
-from .helpers import (handle_deleted_uris, last_run_time,
-                      send_error_notification)
-from .models import FetchRun, FetchRunError
+from .helpers import (DeleteNotifier, drop_delete_requests, encode_params,
+                      handle_deleted_uris, instantiate_index_session,
+                      instantiate_session, last_run_time,
+                      replay_delete_requests, send_error_notification,
+                      session_stats)
+from .metrics import CONTENT_TYPE, LatencyHistogram
+from .models import DeleteRequest, FetchRun, FetchRunError, ProfileRequest
+from .scheduler import Scheduler
+from .sharding import claim_shard, finish_parent_run
 from .views import FetchRunViewSet
 
 archivesspace_vcr = vcr.VCR(
@@ -48,6 +64,18 @@ cartographer_vcr = vcr.VCR(
 )
 
 
+class InlineExecutor(Executor):
+    """Runs calls in the calling thread, so they use the test's transaction."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
 class FetcherTest(TestCase):
     def setUp(self):
         self.factory = APIRequestFactory()
@@ -64,23 +92,91 @@ class FetcherTest(TestCase):
                     f.start_time = time
                     f.save()
 
-    @patch("transformer.transformers.Transformer.run")
+    @patch("pisces.settings.PROBE_CHANGES", False)
+    @patch("fetcher.helpers.send_delete_request")
+    @patch("transformer.transformers.DataObjectWriter.add")
+    @patch("transformer.transformers.Transformer.transform")
     @patch("merger.mergers.BaseMerger.merge")
     @patch("fetcher.helpers.identifier_from_uri")
-    def test_fetchers(self, mock_id, mock_merger, mock_transformer):
+    def test_fetchers(self, mock_id, mock_merger, mock_transformer, mock_save, mock_delete):
         mock_id.return_value = None
         mock_merger.return_value = {}, {}
         mock_transformer.return_value = {}
-        for object_type_choices, fetcher, fetcher_vcr, cassette_prefix, statuses in [
-                (FetchRun.ARCHIVESSPACE_OBJECT_TYPE_CHOICES, ArchivesSpaceDataFetcher, archivesspace_vcr, "ArchivesSpace", ["updated", "deleted"]),
-                (FetchRun.CARTOGRAPHER_OBJECT_TYPE_CHOICES, CartographerDataFetcher, cartographer_vcr, "Cartographer", ["updated"])]:
+        for object_type_choices, fetcher, fetcher_vcr, cassette_prefix, client, statuses in [
+                (FetchRun.ARCHIVESSPACE_OBJECT_TYPE_CHOICES, ArchivesSpaceDataFetcher, archivesspace_vcr, "ArchivesSpace", "aspace", ["updated", "deleted"]),
+                (FetchRun.CARTOGRAPHER_OBJECT_TYPE_CHOICES, CartographerDataFetcher, cartographer_vcr, "Cartographer", "cartographer", ["updated"])]:
             for status in statuses:
                 for object_type, _ in object_type_choices:
                     with fetcher_vcr.use_cassette("{}-{}-{}.json".format(cassette_prefix, status, object_type)):
-                        processed = fetcher().fetch(status, object_type)
+                        instance = fetcher()
+                        processed = instance.fetch(status, object_type)
                         self.assertTrue(isinstance(processed, int))
+                    run = FetchRun.objects.get(pk=instance.current_run.pk)
+                    self.assertEqual(run.error_count, 0)
+                    metrics = run.metrics
+                    self.assertEqual(metrics["processed"], processed)
+                    if status == "updated":
+                        self.assertEqual(processed, metrics["fetched"])
+                    self.assertEqual(metrics["stages"]["merge"]["items"], processed if status == "updated" else 0)
+                    self.assertEqual(metrics["merged"], metrics["stages"]["merge"]["results"])
+                    self.assertEqual(sum(metrics["stages"]["merge"]["latency"].values()), metrics["stages"]["merge"]["items"])
+                    self.assertTrue(metrics["connections"][client]["bytes"] > 0)
+                    if status == "updated" and metrics["fetched"]:
+                        self.assertTrue(metrics["connections"]["async"]["bytes"] > 0)
             self.assertTrue(len(FetchRun.objects.all()), len(object_type_choices) * 2)
 
+    @patch("pisces.settings.PROBE_CHANGES", False)
+    @patch("transformer.transformers.DataObjectWriter.add")
+    def test_transform_processes(self, mock_add):
+        sampler = ValidationSampler(sample_rate=2)
+        with patch.dict("pisces.settings.PIPELINE", transform_processes=1), patch("fetcher.fetchers.sampler", sampler):
+            with archivesspace_vcr.use_cassette("ArchivesSpace-updated-subject.json"):
+                fetcher = ArchivesSpaceDataFetcher()
+                processed = fetcher.fetch("updated", "subject")
+        self.assertEqual(sampler.seen["subject"], processed)
+        self.assertTrue(processed > 0)
+        self.assertEqual(fetcher.current_run.error_count, 0)
+        self.assertEqual(mock_add.call_count, processed)
+        self.assertTrue(all(data["type"] == "term" for (data, _), _ in mock_add.call_args_list))
+
+    @patch("pisces.settings.PROBE_CHANGES", False)
+    @patch("transformer.transformers.Transformer.save_validated")
+    @patch("transformer.transformers.DataObjectWriter.upsert")
+    def test_write_failures(self, mock_upsert, mock_save):
+        mock_upsert.side_effect = Exception("batch failed")
+        mock_save.side_effect = Exception("object failed")
+        with archivesspace_vcr.use_cassette("ArchivesSpace-updated-subject.json"):
+            fetcher = ArchivesSpaceDataFetcher()
+            processed = fetcher.fetch("updated", "subject")
+        run = FetchRun.objects.get(pk=fetcher.current_run.pk)
+        self.assertTrue(processed > 0)
+        self.assertEqual(run.error_count, processed)
+        self.assertEqual(run.checkpoint["completed"], 0)
+        self.assertIsNone(run.checkpoint["last_item"])
+        self.assertEqual(run.metrics["saved"], 0)
+        self.assertEqual(run.metrics["unchanged"], 0)
+
+    @patch("fetcher.fetchers.ArchivesSpaceDataFetcher.count_updated")
+    def test_probe(self, mock_count):
+        mock_count.return_value = 0
+        run_count = FetchRun.objects.count()
+        self.assertEqual(ArchivesSpaceDataFetcher().fetch("updated", "subject"), 0)
+        self.assertEqual(FetchRun.objects.count(), run_count)
+        last_run = FetchRun.objects.filter(
+            status=FetchRun.FINISHED, object_type="subject", object_status="updated").latest("start_time")
+        self.assertEqual(last_run.metrics["skipped"], 1)
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.object_status = "updated"
+        fetcher.object_type = "subject"
+        mock_count.side_effect = Exception("Connection refused")
+        self.assertTrue(fetcher.has_changes())
+        fetcher.object_status = "deleted"
+        fetcher.last_run = 0
+        with patch("fetcher.fetchers.instantiate_aspace") as mock_aspace:
+            mock_aspace.return_value.client.get_paged.return_value = [
+                "/repositories/2/archival_objects/1", "/subjects/1", "/agents/people/1"]
+            self.assertEqual(fetcher.count_deleted(), 1)
+
     def test_action_views(self):
         for action in ["archivesspace", "cartographer", "archival_objects",
                        "families", "organizations", "people", "resources",
@@ -92,6 +188,109 @@ class FetcherTest(TestCase):
                 response.status_code, 200,
                 "View error:  {}".format(response.data))
 
+    def test_queue(self):
+        view = FetchRunViewSet.as_view({"get": "queue"})
+        response = view(self.factory.get("fetchrun-queue"))
+        self.assertEqual(response.status_code, 200, "View error:  {}".format(response.data))
+        self.assertEqual(len(response.data), len(FETCH_JOBS))
+        priorities = [job["priority"] for job in response.data]
+        self.assertEqual(priorities, sorted(priorities, reverse=True))
+        self.assertEqual(Scheduler(FETCH_JOBS).next_job(FETCH_JOBS).code, response.data[0]["code"])
+
+    def test_profiling(self):
+        view = FetchRunViewSet.as_view({"post": "request_profile"})
+        response = view(self.factory.post("fetchrun-request-profile", {"source": "foo"}, format="json"))
+        self.assertEqual(response.status_code, 400)
+        for sample_rate in ["foo", 0]:
+            response = view(self.factory.post(
+                "fetchrun-request-profile",
+                {"source": "ArchivesSpace", "object_type": "subject", "object_status": "updated", "sample_rate": sample_rate},
+                format="json"))
+            self.assertEqual(response.status_code, 400)
+        response = view(self.factory.post(
+            "fetchrun-request-profile",
+            {"source": "ArchivesSpace", "object_type": "subject", "object_status": "updated", "sample_rate": 2},
+            format="json"))
+        self.assertEqual(response.status_code, 200, "View error:  {}".format(response.data))
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.object_type, fetcher.object_status = "subject", "updated"
+        profiler = fetcher.get_profiler()
+        self.assertEqual(profiler.sample_rate, 2)
+        self.assertFalse(ProfileRequest.objects.exists())
+        self.assertIsNone(fetcher.get_profiler())
+
+        for _ in range(3):
+            fetcher.profiler = profiler
+            self.assertEqual(fetcher.profile("merge", sorted, [3, 1, 2]), [1, 2, 3])
+        summary = profiler.summary()
+        self.assertEqual((summary["merge"]["seen"], summary["merge"]["sampled"]), (3, 2))
+        self.assertTrue(any("sorted" in f["function"] for f in summary["merge"]["functions"]))
+        run = FetchRun.objects.all()[0]
+        view = FetchRunViewSet.as_view({"get": "profile"})
+        response = view(self.factory.get("fetchrun-profile"), pk=run.pk)
+        self.assertEqual(response.status_code, 404)
+        run.profile = summary
+        run.save()
+        for limit in ["foo", -1]:
+            response = view(self.factory.get("fetchrun-profile", {"limit": limit}), pk=run.pk)
+            self.assertEqual(response.status_code, 400)
+        response = view(self.factory.get("fetchrun-profile", {"sort": "tottime", "limit": 1}), pk=run.pk)
+        self.assertEqual(response.status_code, 200, "View error:  {}".format(response.data))
+        self.assertEqual(len(response.data["merge"]["functions"]), 1)
+
+    def test_metrics(self):
+        def scrape():
+            response = self.client.get(reverse("metrics"))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], CONTENT_TYPE)
+            lines = response.content.decode().splitlines()
+            return dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+        for seconds in [0.001, 100]:
+            latency = LatencyHistogram({})
+            latency.observe(seconds)
+            FetchRun.objects.create(
+                status=FetchRun.FINISHED,
+                source=FetchRun.ARCHIVESSPACE,
+                object_type="subject",
+                object_status="updated",
+                end_time=timezone.now(),
+                metrics={
+                    "invalid": 1,
+                    "stages": {"merge": {"items": 1, "errors": 0, "seconds": seconds, "blocked": 0, "latency": latency.counts}},
+                    "caches": {"merge": {"hits": 1, "misses": 1}}})
+        DataObject.objects.create(es_id="foo", object_type="term", data={}, indexed=False)
+        labels = 'source="archivesspace",object_type="subject"'
+        expected = {
+            "pisces_validation_failures_total{{{}}}".format(labels): "2",
+            'pisces_stage_seconds_bucket{{{},stage="merge",le="0.005"}}'.format(labels): "1",
+            'pisces_stage_seconds_bucket{{{},stage="merge",le="+Inf"}}'.format(labels): "2",
+            'pisces_stage_seconds_count{{{},stage="merge"}}'.format(labels): "2",
+            'pisces_stage_seconds_sum{{{},stage="merge"}}'.format(labels): "100.001",
+            'pisces_cache_hit_ratio{{{},cache="merge"}}'.format(labels): "0.5",
+            'pisces_dataobject_backlog{object_type="term"}': "1",
+        }
+        samples = scrape()
+        for name, value in expected.items():
+            self.assertEqual(samples[name], value)
+        CleanUpCompleted().do()
+        self.assertEqual(FetchRun.objects.filter(object_type="subject", object_status="updated").count(), 1)
+        self.assertEqual(scrape(), samples)
+
+        errored = FetchRun.objects.create(
+            status=FetchRun.ERRORED,
+            source=FetchRun.ARCHIVESSPACE,
+            object_type="subject",
+            object_status="updated",
+            metrics={"invalid": 1})
+        samples = scrape()
+        self.assertEqual(samples["pisces_validation_failures_total{{{}}}".format(labels)], "3")
+        view = FetchRunViewSet.as_view({"delete": "destroy"})
+        response = view(self.factory.delete("fetchrun-detail"), pk=errored.pk)
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(FetchRun.objects.filter(pk=errored.pk).exists())
+        self.assertEqual(scrape(), samples)
+
     def test_update_time(self):
         initial_count = len(FetchRun.objects.all())
         view = FetchRunViewSet.as_view({"post": "update_time"})
@@ -121,10 +320,50 @@ class FetcherTest(TestCase):
                     updated_last_run = last_run_time(source, object_status, object)
                     self.assertEqual(updated_last_run, int(time.timestamp()))
 
-    @patch("transformer.transformers.Transformer.run")
+    def test_last_run_queries(self):
+        """Checks last_run_time matches separate existence and ordering queries."""
+        def expected_last_run(source, object_status, object_type):
+            runs = FetchRun.objects.filter(
+                status=FetchRun.FINISHED,
+                source=source,
+                object_type=object_type,
+                object_status=object_status,
+                parent__isnull=True)
+            if runs.exists():
+                return int(runs.order_by("-start_time")[0].start_time.timestamp())
+            return 0
+
+        for days, (status, _) in enumerate(FetchRun.STATUS_CHOICES):
+            for source, source_name in FetchRun.SOURCE_CHOICES:
+                for object_type, _ in getattr(FetchRun, "{}_OBJECT_TYPE_CHOICES".format(source_name.upper())):
+                    run = FetchRun.objects.create(
+                        status=status, source=source, object_type=object_type, object_status="updated")
+                    run.start_time = pytz.utc.localize(datetime(2020, 4, 1 + days))
+                    run.save()
+                    shard = FetchRun.objects.create(
+                        status=FetchRun.FINISHED, source=source, object_type=object_type, object_status="updated", parent=run)
+                    shard.start_time = pytz.utc.localize(datetime(2020, 5, 1))
+                    shard.save()
+        FetchRun.objects.filter(object_type="subject", object_status="deleted").delete()
+        for object_status, _ in FetchRun.OBJECT_STATUS_CHOICES:
+            for source, source_name in FetchRun.SOURCE_CHOICES:
+                for object_type, _ in getattr(FetchRun, "{}_OBJECT_TYPE_CHOICES".format(source_name.upper())):
+                    self.assertEqual(
+                        last_run_time(source, object_status, object_type),
+                        expected_last_run(source, object_status, object_type))
+        finished_day = 1 + [status for status, _ in FetchRun.STATUS_CHOICES].index(FetchRun.FINISHED)
+        self.assertEqual(
+            last_run_time(FetchRun.ARCHIVESSPACE, "updated", "subject"),
+            int(pytz.utc.localize(datetime(2020, 4, finished_day)).timestamp()))
+        self.assertEqual(last_run_time(FetchRun.ARCHIVESSPACE, "deleted", "subject"), 0)
+
+    @patch("pisces.settings.PROBE_CHANGES", False)
+    @patch("fetcher.helpers.send_delete_request")
+    @patch("transformer.transformers.DataObjectWriter.add")
+    @patch("transformer.transformers.Transformer.transform")
     @patch("merger.mergers.BaseMerger.merge")
     @patch("fetcher.helpers.identifier_from_uri")
-    def test_cron(self, mock_id, mock_merger, mock_transformer):
+    def test_cron(self, mock_id, mock_merger, mock_transformer, mock_save, mock_delete):
         for fetcher_vcr, cassette, cron in [
                 (archivesspace_vcr, "ArchivesSpace-deleted-agent_corporate_entity.json", DeletedArchivesSpaceOrganizations),
                 (archivesspace_vcr, "ArchivesSpace-updated-agent_corporate_entity.json", UpdatedArchivesSpaceOrganizations),
@@ -161,6 +400,26 @@ class FetcherTest(TestCase):
         self.assertNotIn("errors", mail.outbox[0].subject)
         self.assertIn(error.message, mail.outbox[0].body)
 
+    def test_error_count(self):
+        fetch_run = FetchRun.objects.create(
+            object_type="subject",
+            source=FetchRun.ARCHIVESSPACE,
+            status=FetchRun.FINISHED,
+            object_status="updated")
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.current_run = fetch_run
+        fetcher.errors = []
+        fetcher.record_error("First error")
+        fetcher.record_error("Second error")
+        self.assertEqual(fetch_run.error_count, 0)
+        fetcher.save_errors()
+        self.assertEqual(fetch_run.error_count, 2)
+        self.assertEqual([e.message for e in fetch_run.errors], ["First error", "Second error"])
+        view = FetchRunViewSet.as_view({"get": "list"})
+        response = view(self.factory.get("fetchrun-list"))
+        counts = {r["url"].rstrip("/").split("/")[-1]: r["error_count"] for r in response.data["results"]}
+        self.assertEqual(counts[str(fetch_run.pk)], 2)
+
     def test_cleanup(self):
         for source_id, source in FetchRun.SOURCE_CHOICES:
             for obj_type, _ in getattr(FetchRun, "{}_OBJECT_TYPE_CHOICES".format(source.upper())):
@@ -174,6 +433,142 @@ class FetcherTest(TestCase):
                             source=source_id, object_type=obj_type,
                             object_status=obj_status, status=FetchRun.FINISHED)), 1)
 
+    @patch("pisces.settings.TREE_INDEX_THRESHOLD", 1)
+    def test_index_resource_trees(self):
+        """Tests tree walks for pages from different resources fetched concurrently."""
+        trees = {
+            "/repositories/2/resources/1": {
+                "root": [{"uri": "/repositories/2/archival_objects/1", "child_count": 2, "waypoints": 1}],
+                "/repositories/2/archival_objects/1": [
+                    {"uri": "/repositories/2/archival_objects/2", "child_count": 0, "waypoints": 0},
+                    {"uri": "/repositories/2/archival_objects/3", "child_count": 0, "waypoints": 0}]},
+            "/repositories/2/resources/2": {
+                "root": [{"uri": "/repositories/2/archival_objects/4", "child_count": 0, "waypoints": 0}]},
+        }
+
+        class TreeClient:
+            async def get(self, path, params=None):
+                await asyncio.sleep(0)
+                resource_uri = path.split("/tree/")[0]
+                if path.endswith("/tree/root"):
+                    return {"waypoints": 1}
+                return trees[resource_uri][(params or {}).get("parent_node", "root")]
+
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.resource_counts = Counter()
+        fetcher.indexed_resources = set()
+        fetcher.cache = LRUCache(10)
+        fetcher.async_client = TreeClient()
+        pages = [[{"resource": {"ref": resource_uri}}] for resource_uri in trees]
+        asyncio.get_event_loop().run_until_complete(
+            asyncio.gather(*[fetcher.index_resource_trees(page) for page in pages]))
+        self.assertEqual(fetcher.indexed_resources, set(trees))
+        self.assertEqual(
+            fetcher.cache.get(("child_counts", "/repositories/2/resources/1")),
+            {"/repositories/2/archival_objects/1": 2, "/repositories/2/archival_objects/2": 0, "/repositories/2/archival_objects/3": 0})
+        self.assertEqual(
+            fetcher.cache.get(("child_counts", "/repositories/2/resources/2")),
+            {"/repositories/2/archival_objects/4": 0})
+
+    def test_instantiate_session(self):
+        config = {"retries": 2, "backoff_factor": 0, "pool_size": 2, "timeout": 0.2}
+        adapter = instantiate_session(config=config).get_adapter("http://localhost")
+        self.assertEqual(adapter.timeout, 0.2)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertTrue(adapter.max_retries.is_retry("GET", 503))
+        self.assertFalse(adapter.max_retries.is_retry("POST", 503))
+        adapter = instantiate_index_session(config=config).get_adapter("http://localhost")
+        self.assertTrue(adapter.max_retries.is_retry("POST", 503))
+
+    def test_session_stats(self):
+        config = {"retries": 2, "backoff_factor": 0, "pool_size": 2, "timeout": 0.2}
+        responses = {
+            ("GET", "/ok", ()): {"status": {"code": 200}, "headers": {}, "body": {"string": "{}"}},
+            ("GET", "/unavailable", ()): {"status": {"code": 503}, "headers": {}, "body": {"string": "{}"}},
+            ("POST", "/unavailable", ()): {"status": {"code": 503}, "headers": {}, "body": {"string": "{}"}},
+        }
+        with ReplayServer(responses) as server:
+            session = instantiate_session(config=config)
+            for _ in range(3):
+                self.assertEqual(session.get("{}/ok".format(server.url)).status_code, 200)
+            stats = session_stats(session)
+            self.assertEqual(stats["requests"], 3)
+            self.assertEqual(stats["connections"], 1)
+            self.assertEqual(stats["reused"], 2)
+            self.assertEqual(stats["bytes"], 6)
+
+            server.reset_counts()
+            self.assertEqual(session.get("{}/unavailable".format(server.url)).status_code, 503)
+            self.assertEqual(server.reset_counts()["requests"], 3)
+            self.assertEqual(session_stats(session)["retries"], 2)
+            index_session = instantiate_index_session(config=config)
+            self.assertEqual(index_session.post("{}/unavailable".format(server.url)).status_code, 503)
+            self.assertEqual(server.reset_counts()["requests"], 3)
+
+    def test_interrupted_run(self):
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.object_status = "updated"
+        fetcher.object_type = "archival_object"
+        self.assertEqual(fetcher.get_interrupted_run(), None)
+        interrupted = FetchRun.objects.create(
+            status=FetchRun.ERRORED,
+            source=FetchRun.ARCHIVESSPACE,
+            object_type="archival_object",
+            object_status="updated",
+            checkpoint={"modified_since": 0, "completed": 2, "last_item": 12, "to_delete": [], "saved": 2, "unchanged": 0})
+        self.assertEqual(fetcher.get_interrupted_run(), interrupted)
+        self.assertEqual(fetcher.get_remaining([5, 12, 13, 20], interrupted.checkpoint), [13, 20])
+        self.assertEqual(CartographerDataFetcher().get_remaining(["a", "b", "c"], interrupted.checkpoint), ["c"])
+        fetcher.object_status = "deleted"
+        self.assertEqual(fetcher.get_interrupted_run(), None)
+        fetcher.object_status = "updated"
+        FetchRun.objects.create(
+            status=FetchRun.FINISHED,
+            source=FetchRun.ARCHIVESSPACE,
+            object_type="archival_object",
+            object_status="updated")
+        self.assertEqual(fetcher.get_interrupted_run(), None)
+
+    def test_shards(self):
+        parent = FetchRun.objects.create(
+            status=FetchRun.STARTED,
+            source=FetchRun.ARCHIVESSPACE,
+            object_type="archival_object",
+            object_status="updated",
+            metrics={"shards": 2})
+        for identifiers in [[1, 2], [3, 4]]:
+            FetchRun.objects.create(
+                status=FetchRun.QUEUED,
+                source=FetchRun.ARCHIVESSPACE,
+                object_type="archival_object",
+                object_status="updated",
+                parent=parent,
+                identifiers=identifiers)
+        fetcher = ArchivesSpaceDataFetcher()
+        fetcher.object_status = "updated"
+        fetcher.object_type = "archival_object"
+        self.assertEqual(fetcher.get_sharded_run(), parent)
+        first = claim_shard(parent=parent)
+        second = claim_shard(parent=parent)
+        self.assertEqual([first.identifiers, second.identifiers], [[1, 2], [3, 4]])
+        self.assertEqual(claim_shard(parent=parent), None)
+        first.status = FetchRun.FINISHED
+        first.save()
+        self.assertFalse(finish_parent_run(parent))
+        second.status = FetchRun.ERRORED
+        second.save()
+        self.assertTrue(finish_parent_run(parent))
+        parent.refresh_from_db()
+        self.assertEqual(int(parent.status), FetchRun.ERRORED)
+        self.assertEqual(fetcher.get_sharded_run(), None)
+
+    def test_encode_params(self):
+        encoded = encode_params({"id_set": [1, 2], "all_ids": True, "resolve": ["subjects"]})
+        self.assertEqual(
+            encoded,
+            [("id_set[]", "1"), ("id_set[]", "2"), ("all_ids", "True"), ("resolve[]", "subjects")])
+        self.assertEqual(encode_params(None), [])
+
     @patch("fetcher.helpers.requests.post")
     def test_handle_deleted_uris(self, mock_post):
         """Tests POST requests sent to delete objects"""
@@ -189,7 +584,8 @@ class FetcherTest(TestCase):
         uris = []
         for x in range(random.randint(2, 10)):
             uris.append("/repositories/2/resources/{}".format(random.randint(1, 1000)))
-        deleted = loop.run_until_complete(handle_deleted_uris(uris, source, object_type, current_run))
+        executor = InlineExecutor()
+        deleted = loop.run_until_complete(handle_deleted_uris(uris, source, object_type, current_run, executor=executor))
         self.assertEqual(len(deleted), len(uris))
         self.assertEqual(mock_post.call_count, 1)
         identifiers = mock_post.call_args[1]["json"]["identifiers"]
@@ -202,7 +598,68 @@ class FetcherTest(TestCase):
         error_resp.raise_for_status.side_effect = HTTPError("blergh")
         error_resp.json.return_value = {"detail": "foo"}
         mock_post.return_value = error_resp
-        deleted = loop.run_until_complete(handle_deleted_uris(uris, source, object_type, current_run))
+        deleted = loop.run_until_complete(handle_deleted_uris(uris, source, object_type, current_run, executor=executor))
         self.assertFalse(deleted)
         self.assertEqual(len(FetchRunError.objects.all()), 1)
         self.assertEqual(FetchRunError.objects.all()[0].message, "foo")
+        self.assertEqual(DeleteRequest.objects.count(), 1)
+        self.assertEqual(replay_delete_requests(), 0)
+        self.assertEqual(DeleteRequest.objects.get().attempts, 1)
+        with patch("pisces.settings.INDEX_DELETE_BACKOFF", 0):
+            self.assertEqual(replay_delete_requests(), 0)
+            self.assertEqual(DeleteRequest.objects.get().attempts, 2)
+            with patch("pisces.settings.INDEX_DELETE_MAX_ATTEMPTS", 2):
+                mock_post.reset_mock()
+                self.assertEqual(replay_delete_requests(), 0)
+                self.assertFalse(mock_post.called)
+
+        errors = []
+        loop.run_until_complete(handle_deleted_uris(uris, source, object_type, current_run, record_error=errors.append, executor=executor))
+        self.assertEqual(errors, ["foo"])
+        self.assertEqual(len(FetchRunError.objects.all()), 1)
+        self.assertEqual(DeleteRequest.objects.count(), 2)
+        DeleteRequest.objects.order_by("datetime").last().delete()
+
+        mock_post.return_value = Mock(Response())
+        with patch("pisces.settings.INDEX_DELETE_BACKOFF", 0):
+            self.assertEqual(replay_delete_requests(), 1)
+        self.assertEqual(DeleteRequest.objects.count(), 0)
+
+    def test_drop_delete_requests(self):
+        DeleteRequest.objects.create(identifiers=["foo", "bar"])
+        DeleteRequest.objects.create(identifiers=["baz"])
+        drop_delete_requests(["bar", "baz"])
+        self.assertEqual(list(DeleteRequest.objects.values_list("identifiers", flat=True)), [["foo"]])
+
+    @patch("fetcher.helpers.requests.post")
+    def test_delete_notifier(self, mock_post):
+        current_run = FetchRun.objects.create(
+            object_type="subject",
+            source=FetchRun.ARCHIVESSPACE,
+            status=FetchRun.STARTED,
+            object_status="updated")
+        uris = ["/subjects/{}".format(i) for i in range(5)]
+
+        async def notify():
+            notifier = DeleteNotifier(FetchRun.ARCHIVESSPACE, "subject", current_run, executor=InlineExecutor())
+            notifier.extend(uris)
+            self.assertEqual(sorted(notifier), sorted(uris))
+            return await notifier.flush()
+
+        with patch("pisces.settings.INDEX_DELETE_CHUNK_SIZE", 2):
+            deleted = asyncio.get_event_loop().run_until_complete(notify())
+        self.assertEqual(len(deleted), len(uris))
+        self.assertEqual(mock_post.call_count, 3)
+
+    def test_benchmark_replay(self):
+        with ReplayServer(load_cassettes()) as server:
+            resp = requests.get("{}/repositories/101/resources".format(server.url), params={"all_ids": True, "modified_since": 0})
+            self.assertEqual(resp.json(), [3, 4, 5])
+            self.assertEqual(requests.get("{}/foo".format(server.url)).status_code, 404)
+            self.assertEqual(requests.post("{}/index/delete/".format(server.url), json={}).status_code, 200)
+            self.assertEqual(server.reset_counts(), {"requests": 3, "unmatched": ["GET /foo"]})
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(percentile([3, 1, 2, 4], 95), 4)
+        self.assertEqual(
+            compare_results({"jobs": {"foo": {"per_second": 10}}}, {"jobs": {"foo": {"per_second": 15}, "bar": {"per_second": 1}}}),
+            {"foo": 1.5})
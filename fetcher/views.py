@@ -1,13 +1,30 @@
 from datetime import datetime
 
+from django.db.models import Count
+from django.http import HttpResponse
+from django.views import View
+from rest_framework import status as http_status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
-from .models import FetchRun
+from .cron import FETCH_JOBS
+from .metrics import CONTENT_TYPE, delete_runs, render_metrics
+from .models import FetchRun, ProfileRequest
+from .profiling import sort_profile
+from .scheduler import Scheduler
 from .serializers import FetchRunListSerializer, FetchRunSerializer
 
 
+def positive_int(value):
+    """Returns a value as a positive integer, or None if it is not one."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
 class FetchRunViewSet(ModelViewSet):
     """
     retrieve:
@@ -15,15 +32,27 @@ class FetchRunViewSet(ModelViewSet):
 
     list:
         Return paginated data about all FetchRun objects.
+
+    queue:
+        Return the state of scheduled fetch jobs, highest priority first.
+
+    profile:
+        Return profiling stats for a FetchRun, by stage.
+
+    request_profile:
+        Profile the next run of a fetch job.
     """
     model = FetchRun
-    queryset = FetchRun.objects.all().order_by("-start_time")
+    queryset = FetchRun.objects.annotate(num_errors=Count("fetchrunerror")).order_by("-start_time")
 
     def get_serializer_class(self):
         if self.action not in ["create", "retrieve", "update", "partial_update", "destroy"]:
             return FetchRunListSerializer
         return FetchRunSerializer
 
+    def perform_destroy(self, instance):
+        delete_runs(FetchRun.objects.filter(pk=instance.pk))
+
     def get_action_response(self, request, object_type=None, status=None, source=None):
         queryset = self.get_action_queryset(request, object_type, status, source)
         page = self.paginate_queryset(queryset)
@@ -40,7 +69,7 @@ class FetchRunViewSet(ModelViewSet):
             queryset = FetchRun.objects.filter(source=source)
         if status is not None:
             queryset = FetchRun.objects.filter(status=status)
-        return queryset.order_by("-start_time")
+        return queryset.annotate(num_errors=Count("fetchrunerror")).order_by("-start_time")
 
     @action(detail=False)
     def archivesspace(self, request):
@@ -86,6 +115,50 @@ class FetchRunViewSet(ModelViewSet):
     def errored(self, request):
         return self.get_action_response(request, status=FetchRun.ERRORED)
 
+    @action(detail=False)
+    def queue(self, request):
+        """Returns scheduled fetch jobs in priority order."""
+        return Response(Scheduler(FETCH_JOBS).get_queue())
+
+    @action(detail=True)
+    def profile(self, request, pk=None):
+        """Returns the functions with the highest `sort` time in each stage of a profiled run.
+
+        `sort` may be cumtime (the default) or tottime.
+        """
+        run = self.get_object()
+        if not run.profile:
+            return Response({"detail": "Run was not profiled"}, status=http_status.HTTP_404_NOT_FOUND)
+        sort = request.query_params.get("sort", "cumtime")
+        if sort not in ["cumtime", "tottime"]:
+            return Response({"detail": "sort must be cumtime or tottime"}, status=http_status.HTTP_400_BAD_REQUEST)
+        limit = positive_int(request.query_params.get("limit", 20))
+        if limit is None:
+            return Response({"detail": "limit must be a positive integer"}, status=http_status.HTTP_400_BAD_REQUEST)
+        return Response(sort_profile(run.profile, sort, limit))
+
+    @action(detail=False, methods=['post'])
+    def request_profile(self, request):
+        """Requests profiling of the next run of a fetch job."""
+        sources = {name.lower(): source for source, name in FetchRun.SOURCE_CHOICES}
+        source = sources.get(str(request.data.get("source", "")).lower())
+        object_type = request.data.get("object_type")
+        object_status = request.data.get("object_status")
+        if source is None or object_type not in dict(FetchRun.OBJECT_TYPE_CHOICES) or object_status not in dict(FetchRun.OBJECT_STATUS_CHOICES):
+            return Response(
+                {"detail": "A valid source, object_type and object_status are required"},
+                status=http_status.HTTP_400_BAD_REQUEST)
+        sample_rate = positive_int(request.data.get("sample_rate", 1))
+        if sample_rate is None:
+            return Response({"detail": "sample_rate must be a positive integer"}, status=http_status.HTTP_400_BAD_REQUEST)
+        ProfileRequest.objects.create(
+            source=source,
+            object_type=object_type,
+            object_status=object_status,
+            sample_rate=sample_rate)
+        return Response({"detail": "The next {} {} run from {} will be profiled".format(
+            object_status, object_type, FetchRun.SOURCE_CHOICES[source][1])})
+
     @action(detail=False, methods=['post'])
     def update_time(self, request):
         now = datetime.now()
@@ -99,3 +172,10 @@ class FetchRunViewSet(ModelViewSet):
                     object_type=object_type,
                     object_status="updated")
         return Response({"detail": "Updated last fetched time for all sources and objects"})
+
+
+class MetricsView(View):
+    """Returns pipeline metrics in the Prometheus text exposition format."""
+
+    def get(self, request):
+        return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
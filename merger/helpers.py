@@ -1,4 +1,7 @@
 import re
+import threading
+import time
+from collections import OrderedDict
 
 from fetcher.helpers import instantiate_aspace
 from pisces import settings
@@ -79,15 +82,14 @@ def combine_references(object):
     return object
 
 
-def add_group(object, aspace_client):
+def add_group(object, aspace_helper):
     """Adds group object, with data about the highest-level collection containing this object."""
 
     top_ancestor = object
     if object.get("ancestors"):
         last_ancestor = object["ancestors"][-1]
-        top_ancestor = last_ancestor["_resolved"] if last_ancestor.get("_resolved") else aspace_client.get(
-            last_ancestor.get("archivesspace_uri", last_ancestor.get("ref")),
-            params={"resolve": ["linked_agents", "subjects"]}).json()
+        top_ancestor = last_ancestor["_resolved"] if last_ancestor.get("_resolved") else aspace_helper.get_resolved_record(
+            last_ancestor.get("archivesspace_uri", last_ancestor.get("ref")))
 
     group_obj = combine_references(top_ancestor)
 
@@ -111,14 +113,179 @@ def handle_cartographer_reference(reference):
     return reference
 
 
+class LRUCache:
+    """A thread-safe least recently used cache which counts hits and misses.
+
+    Args:
+        max_size (int): the maximum number of items held in the cache.
+        ttl (int): optional number of seconds after which items expire.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.lookup(key) is not self.MISSING
+
+    def lookup(self, key):
+        """Returns an unexpired value or MISSING. Must be called with the lock held."""
+        if key not in self.data:
+            return self.MISSING
+        value, expires = self.data[key]
+        if expires is not None and expires < time.monotonic():
+            del self.data[key]
+            return self.MISSING
+        self.data.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.lookup(key)
+            if value is self.MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """Returns a cached value, calling func to create it if it is missing.
+
+        Values are created outside the lock, so concurrent misses for the same
+        key may each call func.
+        """
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.data),
+            "hit_ratio": self.hits / lookups if lookups else 0}
+
+
+cartographer_cache = LRUCache(settings.CARTOGRAPHER["cache_size"], ttl=settings.CARTOGRAPHER["cache_ttl"])
+
+
+class CartographerHelper:
+    """Looks up ArchivesSpace URIs in Cartographer.
+
+    Results are memoized in a cache shared by all fetch runs in this process,
+    so a changed arrangement map may be used until its cached results expire
+    after settings.CARTOGRAPHER["cache_ttl"] seconds. Cached results are
+    shared and should not be modified.
+
+    Args:
+        client (ElectronBond): a Cartographer client.
+        cache (LRUCache): optional cache, defaults to the shared cache.
+    """
+
+    def __init__(self, client, cache=None):
+        self.client = client
+        self.cache = cache if cache is not None else cartographer_cache
+
+    def find_by_uri(self, uri):
+        """Returns the first arrangement map component matching a URI, or None.
+
+        Unsuccessful responses are not cached.
+        """
+        result = self.cache.get(uri, LRUCache.MISSING)
+        if result is LRUCache.MISSING:
+            result = None
+            resp = self.client.get("/api/find-by-uri/", params={"uri": uri})
+            if resp.status_code == 200:
+                json_data = resp.json()
+                result = json_data["results"][0] if json_data["count"] > 0 else None
+                self.cache.set(uri, result)
+        return result
+
+    def find_by_uris(self, uris):
+        """Looks up a list of URIs, requesting each distinct uncached URI once.
+
+        Returns:
+            dict: URIs mapped to their matching components.
+        """
+        return {uri: self.find_by_uri(uri) for uri in set(uris)}
+
+
 class ArchivesSpaceHelper:
-    def __init__(self, aspace):
+    """Fetches data from ArchivesSpace.
+
+    Records which may be requested repeatedly during a fetch run, such as
+    the collections containing archival objects, are cached. Cached values
+    are shared and should not be modified.
+
+    Args:
+        aspace (ASpace): an ASpace object.
+        cache (LRUCache): an optional cache shared across a fetch run.
+    """
+
+    def __init__(self, aspace, cache=None):
         self.aspace = aspace if aspace else instantiate_aspace(settings.ARCHIVESSPACE)
+        self.cache = cache if cache is not None else LRUCache(settings.MERGE_CACHE_SIZE)
+
+    def get_resolved_record(self, uri):
+        """Returns a record with resolved linked agents and subjects.
+
+        References in the record are combined before it is cached, so the
+        cached record is not altered when it is used to build groups.
+        """
+        return self.cache.get_or_set(
+            ("record", uri),
+            lambda: combine_references(self.aspace.client.get(
+                uri, params={"resolve": ["linked_agents", "subjects"]}).json()))
+
+    def get_tree_node(self, resource_uri, node_uri):
+        """Returns a tree node for an archival object."""
+        return self.aspace.client.get('{}/tree/node?node_uri={}'.format(resource_uri, node_uri)).json()
 
     def has_children(self, uri):
         """Checks whether an archival object has children using the tree/node endpoint.
         Checks the child_count attribute and if the value is greater than 0, return true, otherwise return False."""
         obj = self.aspace.client.get(uri).json()
-        resource_uri = obj['resource']['ref']
-        tree_node = self.aspace.client.get('{}/tree/node?node_uri={}'.format(resource_uri, obj['uri'])).json()
+        return self.record_has_children(obj)
+
+    def record_has_children(self, obj):
+        """Checks whether an already fetched archival object has children.
+
+        Avoids refetching the archival object before requesting its tree node.
+        Uses a child count index for the resource if one has been built by the
+        fetcher.
+        """
+        child_counts = self.cache.get(("child_counts", obj['resource']['ref']))
+        if child_counts and obj['uri'] in child_counts:
+            return True if child_counts[obj['uri']] > 0 else False
+        tree_node = self.get_tree_node(obj['resource']['ref'], obj['uri'])
         return True if tree_node['child_count'] > 0 else False
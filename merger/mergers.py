@@ -1,6 +1,7 @@
-from .helpers import (ArchivesSpaceHelper, add_group, closest_creators,
-                      closest_parent_value, combine_references,
-                      handle_cartographer_reference, indicator_to_integer)
+from .helpers import (ArchivesSpaceHelper, CartographerHelper, add_group,
+                      closest_creators, closest_parent_value,
+                      combine_references, handle_cartographer_reference,
+                      indicator_to_integer)
 
 
 class MergeError(Exception):
@@ -10,10 +11,11 @@ class MergeError(Exception):
 class BaseMerger:
     """Base merger class."""
 
-    def __init__(self, clients):
+    def __init__(self, clients, cache=None):
         try:
-            self.aspace_helper = ArchivesSpaceHelper(clients["aspace"])
+            self.aspace_helper = ArchivesSpaceHelper(clients["aspace"], cache)
             self.cartographer_client = clients["cartographer"]
+            self.cartographer_helper = CartographerHelper(clients["cartographer"])
         except Exception as e:
             raise MergeError(e)
 
@@ -43,7 +45,7 @@ class BaseMerger:
         pass
 
     def combine_data(self, object, additional_data):
-        return add_group(object, self.aspace_helper.aspace.client)
+        return add_group(object, self.aspace_helper)
 
     def get_target_object_type(self, data):
         """Returns object type.
@@ -52,7 +54,7 @@ class BaseMerger:
         without.
         """
         if data.get("jsonmodel_type") == "archival_object":
-            if self.aspace_helper.has_children(data["uri"]):
+            if self.aspace_helper.record_has_children(data):
                 return "archival_object_collection"
         return data.get("jsonmodel_type")
 
@@ -79,13 +81,10 @@ class ArchivalObjectMerger(BaseMerger):
         """Gets ancestors, if any, from the archival object's resource record in
         Cartographer."""
         data = {"ancestors": []}
-        resp = self.cartographer_client.get(
-            "/api/find-by-uri/", params={"uri": object["resource"]["ref"]})
-        if resp.status_code == 200:
-            json_data = resp.json()
-            if json_data["count"] >= 1:
-                for a in json_data["results"][0].get("ancestors"):
-                    data["ancestors"].append(handle_cartographer_reference(a))
+        result = self.cartographer_helper.find_by_uri(object["resource"]["ref"])
+        if result:
+            for a in result.get("ancestors"):
+                data["ancestors"].append(handle_cartographer_reference(dict(a)))
         return data
 
     def get_language_data(self, object, data):
@@ -207,7 +206,7 @@ class ArrangementMapMerger(BaseMerger):
             ancestors.append(handle_cartographer_reference(a))
         additional_data["ancestors"] = ancestors
         additional_data["position"] = object["order"]
-        additional_data = add_group(additional_data, self.aspace_helper.aspace.client)
+        additional_data = add_group(additional_data, self.aspace_helper)
         return combine_references(additional_data)
 
 
@@ -233,15 +232,11 @@ class ResourceMerger(BaseMerger):
         """Returns ancestors (if any) for the resource record from
         Cartographer."""
         data = {"ancestors": []}
-        resp = self.cartographer_client.get(
-            "/api/find-by-uri/", params={"uri": object["uri"]})
-        if resp.status_code == 200:
-            json_data = resp.json()
-            if json_data["count"] > 0:
-                result = json_data["results"][0]
-                data["order"] = result["order"]
-                for a in result.get("ancestors", []):
-                    data["ancestors"].append(handle_cartographer_reference(a))
+        result = self.cartographer_helper.find_by_uri(object["uri"])
+        if result:
+            data["order"] = result["order"]
+            for a in result.get("ancestors", []):
+                data["ancestors"].append(handle_cartographer_reference(dict(a)))
         return data
 
     def combine_data(self, object, additional_data):
@@ -1,11 +1,13 @@
 import json
 import os
+from unittest.mock import Mock, patch
 
 import vcr
 from django.test import TestCase
 from fetcher.fetchers import BaseDataFetcher
 from rest_framework.test import APIRequestFactory
 
+from .helpers import CartographerHelper, LRUCache
 from .mergers import (AgentMerger, ArchivalObjectMerger, ArrangementMapMerger,
                       ResourceMerger, SubjectMerger)
 
@@ -126,3 +128,51 @@ class MergerTest(TestCase):
                     for parsed_pair in source_data:
                         parsed = merger.parse_instances(parsed_pair["source"])
                         self.assertEqual(parsed, parsed_pair["parsed"])
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2)
+        self.assertEqual(cache.get_or_set("a", lambda: 1), 1)
+        self.assertEqual(cache.get_or_set("a", lambda: 2), 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        self.assertNotIn("a", cache)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+        cache.invalidate("b")
+        self.assertIsNone(cache.get("b"))
+
+    def test_lru_cache_expiry(self):
+        cache = LRUCache(max_size=2, ttl=10)
+        with patch("merger.helpers.time.monotonic") as mock_time:
+            mock_time.return_value = 100
+            cache.set("a", 1)
+            mock_time.return_value = 105
+            self.assertEqual(cache.get("a"), 1)
+            mock_time.return_value = 111
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_cartographer_helper(self):
+        """Tests that Cartographer lookups are served from the cache."""
+        component = {"title": "Series 1", "archivesspace_uri": "/repositories/2/resources/1"}
+        client = Mock()
+        client.get.return_value.status_code = 200
+        client.get.return_value.json.return_value = {"count": 1, "results": [component]}
+        helper = CartographerHelper(client, LRUCache(max_size=2))
+        for _ in range(3):
+            self.assertEqual(helper.find_by_uri("/repositories/2/resources/1"), component)
+        self.assertEqual(client.get.call_count, 1)
+        self.assertEqual(helper.cache.stats["hits"], 2)
+
+        found = helper.find_by_uris(["/repositories/2/resources/2", "/repositories/2/resources/3", "/repositories/2/resources/2"])
+        self.assertEqual(len(found), 2)
+        self.assertEqual(client.get.call_count, 3)
+        self.assertEqual(len(helper.cache), 2)
+        self.assertNotIn("/repositories/2/resources/1", helper.cache)
+
+        client.get.return_value.status_code = 500
+        self.assertIsNone(helper.find_by_uri("/repositories/2/resources/4"))
+        self.assertIsNone(helper.find_by_uri("/repositories/2/resources/4"))
+        self.assertEqual(client.get.call_count, 5)
+        self.assertNotIn("/repositories/2/resources/4", helper.cache)
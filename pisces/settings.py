@@ -137,23 +137,17 @@ REST_FRAMEWORK = {
 
 # Django cron settings
 CRON_CLASSES = [
-    "fetcher.cron.DeletedArchivesSpaceArchivalObjects",
-    "fetcher.cron.DeletedArchivesSpaceFamilies",
-    "fetcher.cron.DeletedArchivesSpaceOrganizations",
-    "fetcher.cron.DeletedArchivesSpacePeople",
-    "fetcher.cron.DeletedArchivesSpaceResources",
-    "fetcher.cron.DeletedArchivesSpaceSubjects",
-    "fetcher.cron.DeletedCartographerArrangementMapComponents",
-    "fetcher.cron.UpdatedArchivesSpaceArchivalObjects",
-    "fetcher.cron.UpdatedArchivesSpaceFamilies",
-    "fetcher.cron.UpdatedArchivesSpaceOrganizations",
-    "fetcher.cron.UpdatedArchivesSpacePeople",
-    "fetcher.cron.UpdatedArchivesSpaceResources",
-    "fetcher.cron.UpdatedArchivesSpaceSubjects",
-    "fetcher.cron.UpdatedCartographerArrangementMapComponents",
+    "fetcher.cron.ScheduledFetches",
+    "fetcher.cron.ProcessFetchShards",
+    "fetcher.cron.ReplayDeleteRequests",
 ]
 DJANGO_CRON_LOCK_BACKEND = "django_cron.backends.lock.file.FileLock"
 DJANGO_CRON_LOCKFILE_PATH = config.DJANGO_CRON_LOCKFILE_PATH
+SCHEDULER = {
+    "workers": config.SCHEDULER_WORKERS,
+    "default_cost": config.SCHEDULER_DEFAULT_COST,
+    "poll_interval": config.SCHEDULER_POLL_INTERVAL,
+}
 
 ARCHIVESSPACE = {
     "baseurl": config.AS_BASEURL,
@@ -165,10 +159,50 @@ ARCHIVESSPACE = {
 CARTOGRAPHER = {
     "baseurl": config.CARTOGRAPHER_BASEURL,
     "health_check_path": config.CARTOGRAPHER_HEALTH_CHECK_PATH,
+    "cache_size": config.CARTOGRAPHER_CACHE_SIZE,
+    "cache_ttl": config.CARTOGRAPHER_CACHE_TTL,
 }
 
-CHUNK_SIZE = config.CHUNK_SIZE
+PIPELINE = {
+    "queue_size": config.PIPELINE_QUEUE_SIZE,
+    "fetch_workers": config.PIPELINE_FETCH_WORKERS,
+    "merge_workers": config.PIPELINE_MERGE_WORKERS,
+    "transform_workers": config.PIPELINE_TRANSFORM_WORKERS,
+    "persist_workers": config.PIPELINE_PERSIST_WORKERS,
+    "transform_processes": config.PIPELINE_TRANSFORM_PROCESSES,
+    "persist_batch_size": config.PIPELINE_PERSIST_BATCH_SIZE,
+    "persist_flush_interval": config.PIPELINE_PERSIST_FLUSH_INTERVAL,
+    "checkpoint_interval": config.PIPELINE_CHECKPOINT_INTERVAL,
+    "resume_runs": config.PIPELINE_RESUME_RUNS,
+    "shard_size": config.PIPELINE_SHARD_SIZE,
+    "shard_timeout": config.PIPELINE_SHARD_TIMEOUT,
+}
+HTTP = {
+    "pool_size": max(PIPELINE["fetch_workers"], PIPELINE["merge_workers"]),
+    "timeout": config.HTTP_TIMEOUT,
+    "keepalive_timeout": config.HTTP_KEEPALIVE_TIMEOUT,
+    "retries": config.HTTP_RETRIES,
+    "backoff_factor": config.HTTP_BACKOFF_FACTOR,
+}
+IDENTIFIER_CACHE_SIZE = config.IDENTIFIER_CACHE_SIZE
+MERGE_CACHE_SIZE = config.MERGE_CACHE_SIZE
+PROBE_CHANGES = config.PROBE_CHANGES
+TREE_INDEX_THRESHOLD = config.TREE_INDEX_THRESHOLD
+VALIDATION = {
+    "sample_rate": config.VALIDATION_SAMPLE_RATE,
+    "failure_window": config.VALIDATION_FAILURE_WINDOW,
+}
+PROFILING = {
+    "sample_rate": config.PROFILING_SAMPLE_RATE,
+    "functions": config.PROFILING_FUNCTIONS,
+}
+METRICS = {
+    "buckets": config.METRICS_BUCKETS,
+}
 INDEX_DELETE_URL = config.INDEX_DELETE_URL
+INDEX_DELETE_CHUNK_SIZE = config.INDEX_DELETE_CHUNK_SIZE
+INDEX_DELETE_MAX_ATTEMPTS = config.INDEX_DELETE_MAX_ATTEMPTS
+INDEX_DELETE_BACKOFF = config.INDEX_DELETE_BACKOFF
 
 # Email settings
 EMAIL_HOST = config.EMAIL_HOST
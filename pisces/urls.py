@@ -15,7 +15,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import include, path, re_path
-from fetcher.views import FetchRunViewSet
+from fetcher.views import FetchRunViewSet, MetricsView
 from rest_framework.schemas import get_schema_view
 from transformer.views import DataObjectUpdateByIdView, DataObjectViewSet
 
@@ -35,6 +35,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     re_path(r'^index-complete/$', DataObjectUpdateByIdView.as_view(), name='index-action-complete'),
     path('status/', include('health_check.api.urls')),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('schema/', schema_view, name='schema'),
     path('', include(router.urls)),
 ]
@@ -0,0 +1,164 @@
+"""Benchmarks for transformations, using the fixtures in fixtures/transformer.
+
+Run from the project root with:
+
+    python -m transformer.benchmarks [iterations]
+"""
+
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import odin
+from odin.codecs import dict_codec
+
+FIXTURES_DIR = os.path.join("fixtures", "transformer")
+
+
+def load_fixtures(object_type, fixtures_dir=FIXTURES_DIR):
+    """Returns the parsed fixtures for an object type."""
+    fixtures = []
+    type_dir = os.path.join(fixtures_dir, object_type)
+    for f in sorted(os.listdir(type_dir)):
+        with open(os.path.join(type_dir, f), "r") as json_file:
+            fixtures.append(json.load(json_file))
+    return fixtures
+
+
+def benchmark_transform(iterations=10, fixtures_dir=FIXTURES_DIR):
+    """Times get_transformed_object for each object type.
+
+    Validation and saving are excluded so the cost of mapping and
+    serialization can be measured on its own.
+
+    Returns:
+        dict: object type mapped to the number of objects transformed, total
+        seconds and objects per second.
+    """
+    from .transformers import Transformer
+
+    transformer = Transformer()
+    results = {}
+    for object_type in sorted(os.listdir(fixtures_dir)):
+        from_resource, mapping, _ = transformer.get_mapping_classes(object_type)
+        fixtures = load_fixtures(object_type, fixtures_dir)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            for source in fixtures:
+                transformer.get_transformed_object(source, from_resource, mapping)
+        elapsed = time.perf_counter() - start
+        count = len(fixtures) * iterations
+        results[object_type] = {
+            "count": count,
+            "seconds": elapsed,
+            "per_second": count / elapsed if elapsed else 0}
+    return results
+
+
+class MappingProfiler:
+    """Times odin mappings, and each of the rules which make them up.
+
+    While in use, every Mapping.convert and Mapping._apply_rule call is timed.
+    Times are inclusive, so the cost of a rule which applies another mapping,
+    such as notes or terms, includes the cost of that mapping. Timing adds
+    overhead, so totals are only comparable with other profiled runs.
+    """
+
+    def __init__(self):
+        self.mappings = defaultdict(lambda: {"calls": 0, "seconds": 0})
+        self.rules = defaultdict(lambda: {"calls": 0, "seconds": 0})
+
+    def __enter__(self):
+        self.convert = odin.Mapping.convert
+        self.apply_rule = odin.Mapping._apply_rule
+        profiler = self
+
+        def convert(mapping, **field_values):
+            start = time.perf_counter()
+            try:
+                return profiler.convert(mapping, **field_values)
+            finally:
+                profiler.record(profiler.mappings[mapping.__class__.__name__], start)
+
+        def apply_rule(mapping, mapping_rule):
+            start = time.perf_counter()
+            try:
+                return profiler.apply_rule(mapping, mapping_rule)
+            finally:
+                name = "{}.{}".format(mapping.__class__.__name__, rule_name(mapping_rule))
+                profiler.record(profiler.rules[name], start)
+
+        odin.Mapping.convert = convert
+        odin.Mapping._apply_rule = apply_rule
+        return self
+
+    def __exit__(self, *exc):
+        odin.Mapping.convert = self.convert
+        odin.Mapping._apply_rule = self.apply_rule
+
+    def record(self, timing, start):
+        timing["calls"] += 1
+        timing["seconds"] += time.perf_counter() - start
+
+
+def rule_name(mapping_rule):
+    """Returns the name of the method applying a mapping rule, or the fields set by a basic mapping."""
+    action, to_fields = mapping_rule[1], mapping_rule[2]
+    name = action if isinstance(action, str) else getattr(action, "__name__", None)
+    return ",".join(to_fields) if name in (None, "default_action") else name
+
+
+def benchmark_mappings(iterations=10, fixtures_dir=FIXTURES_DIR):
+    """Times each mapping, and each of its rules, applied to the fixtures.
+
+    Fixtures are decoded before timing starts, and transformed objects are
+    not serialized, so only the cost of mapping is measured.
+
+    Returns:
+        dict: "mappings" and "rules", each mapping names to the number of
+        calls, total seconds and seconds per call, most expensive first.
+    """
+    from .transformers import Transformer
+
+    transformer = Transformer()
+    with MappingProfiler() as profiler:
+        for object_type in sorted(os.listdir(fixtures_dir)):
+            from_resource, mapping, _ = transformer.get_mapping_classes(object_type)
+            sources = [dict_codec.load(data, resource=from_resource) for data in load_fixtures(object_type, fixtures_dir)]
+            for _ in range(iterations):
+                for source in sources:
+                    mapping.apply(source)
+    return {
+        "mappings": summarize_timings(profiler.mappings),
+        "rules": summarize_timings(profiler.rules)}
+
+
+def summarize_timings(timings):
+    return {
+        name: dict(timing, per_call=timing["seconds"] / timing["calls"])
+        for name, timing in sorted(timings.items(), key=lambda t: -t[1]["seconds"])}
+
+
+def print_results(results):
+    for name, result in results.items():
+        print("{:<40} {:>8} {:>10.3f}s {:>10.1f}/s".format(
+            name, result["count"], result["seconds"], result["per_second"]))
+
+
+def print_mapping_results(results, limit=30):
+    for key in ("mappings", "rules"):
+        print("\n{:<70} {:>8} {:>10} {:>12}".format(key, "calls", "total", "per call"))
+        for name, timing in list(results[key].items())[:limit]:
+            print("{:<70} {:>8} {:>9.3f}s {:>10.1f}us".format(
+                name, timing["calls"], timing["seconds"], timing["per_call"] * 1000000))
+
+
+if __name__ == "__main__":
+    import django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pisces.settings")
+    django.setup()
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print_results(benchmark_transform(iterations))
+    print_mapping_results(benchmark_mappings(iterations))
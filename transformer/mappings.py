@@ -1,8 +1,9 @@
 import json
+from functools import lru_cache
+from types import MappingProxyType
 
 import odin
 from fetcher.helpers import identifier_from_uri
-from iso639 import languages
 from pisces import settings
 
 from .resources.configs import NOTE_TYPE_CHOICES, NOTE_TYPE_CHOICES_TRANSFORM
@@ -21,11 +22,21 @@ def replace_xml(content_list):
     return [c.replace("extref", "a") for c in content_list]
 
 
+@lru_cache(maxsize=None)
+def get_language_names():
+    """Returns a read-only mapping of ISO 639-2/B codes to language names.
+
+    The ISO 639 tables are imported and indexed the first time this is called
+    in a process, rather than when mappings are imported.
+    """
+    from iso639 import languages
+    return MappingProxyType({code: lang.name for code, lang in languages.part2b.items() if code})
+
+
 def transform_language(value, lang_materials):
     langz = []
     if value:
-        lang_data = languages.get(part2b=value)
-        langz.append(Language(expression=lang_data.name, identifier=value))
+        langz.append(Language(expression=get_language_names()[value], identifier=value))
     elif lang_materials:
         for lang in [l for l in lang_materials if l.language_and_script]:
             langz += transform_language(lang.language_and_script.language, None)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-18 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transformer', '0006_auto_20201119_0907'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataobject',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
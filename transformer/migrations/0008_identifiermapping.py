@@ -0,0 +1,21 @@
+# Generated by Django 2.2.13 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transformer', '0007_dataobject_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdentifierMapping',
+            fields=[
+                ('uri', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('es_id', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
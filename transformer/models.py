@@ -12,6 +12,14 @@ class DataObject(models.Model):
     es_id = models.CharField(primary_key=True, max_length=255)
     object_type = models.CharField(max_length=255, choices=TYPE_CHOICES)
     data = JSONField()
+    content_hash = models.CharField(max_length=64, blank=True, default="")
     indexed = models.BooleanField(default=False)
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
+
+
+class IdentifierMapping(models.Model):
+    """Maps a source URI to the identifier of the DataObject created from it."""
+    uri = models.CharField(primary_key=True, max_length=255)
+    es_id = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
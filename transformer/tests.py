@@ -1,15 +1,23 @@
 import json
 import os
 import random
+from unittest.mock import patch
 
+import odin
 from django.test import TestCase
 from django.urls import reverse
-from fetcher.helpers import identifier_from_uri
+from fetcher.helpers import identifier_from_uri, identifiers_from_uris
+from fetcher.models import DeleteRequest
+from odin.codecs import json_codec
+from rac_schemas.exceptions import ValidationError as SchemaValidationError
 from rest_framework.test import APIRequestFactory
 
-from .models import DataObject
+from .benchmarks import benchmark_mappings
+from .mappings import get_language_names, transform_language
+from .models import DataObject, IdentifierMapping
 from .resources.configs import NOTE_TYPE_CHOICES_TRANSFORM
-from .transformers import Transformer
+from .transformers import DataObjectWriter, Transformer
+from .validators import ValidationSampler, get_validator, validate
 from .views import DataObjectUpdateByIdView, DataObjectViewSet
 
 object_types = ["agent_corporate_entity", "agent_family", "agent_person",
@@ -46,6 +54,29 @@ class TransformerTest(TestCase):
                     self.check_component_id(source, transformed)
                     self.check_position(transformed, object_type)
 
+    def test_transformed_object_encoder(self):
+        """Checks transformed objects match a JSON round trip with type fields removed."""
+        def remove_type_fields(data):
+            if isinstance(data, dict):
+                return {k: remove_type_fields(v) for k, v in data.items() if k != "$"}
+            if isinstance(data, list):
+                return [remove_type_fields(i) for i in data]
+            return data
+
+        dated = 0
+        for object_type in object_types:
+            from_resource, mapping, _ = Transformer().get_mapping_classes(object_type)
+            for f in os.listdir(os.path.join("fixtures", "transformer", object_type)):
+                with open(os.path.join("fixtures", "transformer", object_type, f), "r") as json_file:
+                    source = json.load(json_file)
+                mapped = mapping.apply(json_codec.loads(json.dumps(source), resource=from_resource))
+                expected = remove_type_fields(json.loads(json_codec.dumps(mapped)))
+                self.assertEqual(
+                    Transformer().get_transformed_object(source, from_resource, mapping), expected,
+                    "Transformed {} {} does not match a JSON round trip".format(object_type, f))
+                dated += len([d for d in expected.get("dates", []) if d.get("begin")])
+        self.assertTrue(dated > 0, "No fixtures with dates were transformed")
+
     def check_list_counts(self, source, transformed, object_type):
         """Checks that lists of items are the same on source and data objects.
 
@@ -186,6 +217,88 @@ class TransformerTest(TestCase):
                     final_count, "{} {} objects were expected but {} found".format(
                         final_count, object_type, len(DataObject.objects.filter(object_type=object_type))))
 
+    def test_data_object_writer(self):
+        writer = DataObjectWriter(batch_size=2, flush_interval=60)
+        writer.add({"uri": "/objects/foo", "type": "object", "title": "Foo"})
+        self.assertEqual(DataObject.objects.count(), 0)
+        writer.add({"uri": "/objects/bar", "type": "object", "title": "Bar"})
+        self.assertEqual(DataObject.objects.count(), 2)
+        DataObject.objects.filter(es_id="foo").update(indexed=True)
+        writer.add({"uri": "/objects/foo", "type": "object", "title": "Foo updated"})
+        self.assertEqual(writer.flush(), 1)
+        updated = DataObject.objects.get(es_id="foo")
+        self.assertEqual(updated.data["title"], "Foo updated")
+        self.assertFalse(updated.indexed)
+        self.assertEqual(DataObject.objects.count(), 2)
+        updated.indexed = True
+        updated.save()
+        writer.add({"uri": "/objects/foo", "type": "object", "title": "Foo updated"})
+        self.assertEqual(writer.flush(), 0)
+        self.assertEqual(writer.unchanged, 1)
+        self.assertTrue(DataObject.objects.get(es_id="foo").indexed)
+        self.assertFalse(Transformer().save_validated(updated.data))
+
+    def test_data_object_writer_fallback(self):
+        DeleteRequest.objects.create(identifiers=["foo", "bar"])
+        writer = DataObjectWriter(batch_size=3, flush_interval=60)
+        with patch("transformer.transformers.DataObjectWriter.upsert", side_effect=Exception("batch failed")):
+            writer.add({"uri": "/objects/foo", "type": "object", "title": "Foo"})
+            writer.add({"uri": "/objects/bar", "title": "Bar"})
+            writer.add({"uri": "/objects/baz", "type": "object", "title": "Baz"})
+        self.assertEqual(writer.saved, 2)
+        self.assertEqual(writer.unchanged, 0)
+        self.assertEqual(sorted(DataObject.objects.values_list("es_id", flat=True)), ["baz", "foo"])
+        failed = writer.pop_failed()
+        self.assertEqual([uri for uri, _ in failed], ["/objects/bar"])
+        self.assertEqual(writer.pop_failed(), [])
+        self.assertEqual(DeleteRequest.objects.get().identifiers, ["bar"])
+
+    def test_identifier_mapping(self):
+        uri = "/repositories/2/resources/1"
+        es_id = identifier_from_uri(uri)
+        hits = identifier_from_uri.cache_info().hits
+        self.assertEqual(identifier_from_uri(uri), es_id)
+        self.assertEqual(identifier_from_uri.cache_info().hits, hits + 1)
+        writer = DataObjectWriter(batch_size=1, flush_interval=60)
+        writer.add({
+            "uri": "/collections/{}".format(es_id),
+            "type": "collection",
+            "external_identifiers": [{"identifier": uri, "source": "archivesspace"}]})
+        self.assertEqual(IdentifierMapping.objects.get(uri=uri).es_id, es_id)
+        IdentifierMapping.objects.filter(uri=uri).update(es_id="foo")
+        other_uri = "/repositories/2/resources/2"
+        self.assertEqual(
+            identifiers_from_uris([uri, other_uri]),
+            {uri: "foo", other_uri: identifier_from_uri(other_uri)})
+
+    def test_transform_language(self):
+        self.assertIs(get_language_names(), get_language_names())
+        self.assertEqual(transform_language("fre", None)[0].expression, "French")
+        self.assertEqual(transform_language(None, None)[0].identifier, "eng")
+        with self.assertRaises(KeyError):
+            transform_language("foo", None)
+
+    def test_mapping_benchmarks(self):
+        convert = odin.Mapping.convert
+        results = benchmark_mappings(1)
+        self.assertIs(odin.Mapping.convert, convert)
+        self.assertEqual(results["mappings"]["SourceArchivalObjectToObject"]["calls"], len(os.listdir("fixtures/transformer/archival_object")))
+        self.assertIn("SourceArchivalObjectToObject.notes", results["rules"])
+
+    def test_validators(self):
+        self.assertIs(get_validator("agent.json"), get_validator("agent.json"))
+        with self.assertRaises(SchemaValidationError):
+            validate({"title": "Foo"}, "agent.json")
+        sampler = ValidationSampler(sample_rate=3, failure_window=2)
+        self.assertEqual(
+            [sampler.should_validate("agent") for _ in range(4)],
+            [True, False, False, True])
+        sampler.record_failure("agent")
+        self.assertEqual(
+            [sampler.should_validate("agent") for _ in range(4)],
+            [True, True, True, False])
+        self.assertTrue(ValidationSampler().should_validate("agent"))
+
     def test_transformer(self):
         self.mappings()
         self.views()
@@ -1,18 +1,71 @@
+import hashlib
 import json
+import threading
+import time
 
+import django
+from django.db import connection, transaction
+from django.utils import timezone
+from fetcher.helpers import drop_delete_requests
 from jsonschema.exceptions import ValidationError
-from odin.codecs import json_codec
-from rac_schemas import is_valid
+from odin.codecs import dict_codec, json_codec
+from pisces import settings
+from rac_schemas.exceptions import ValidationError as SchemaValidationError
 
 from .mappings import (SourceAgentCorporateEntityToAgent,
                        SourceAgentFamilyToAgent, SourceAgentPersonToAgent,
                        SourceArchivalObjectToCollection,
                        SourceArchivalObjectToObject,
                        SourceResourceToCollection, SourceSubjectToTerm)
-from .models import DataObject
+from .models import DataObject, IdentifierMapping
 from .resources.source import (SourceAgentCorporateEntity, SourceAgentFamily,
                                SourceAgentPerson, SourceArchivalObject,
                                SourceResource, SourceSubject)
+from .validators import sampler, validate, warm_validators
+
+
+def init_transform_process():
+    """Prepares a worker process to run transformations.
+
+    Ensures Django is configured when the process was not forked from an
+    already configured parent, and compiles schema validators up front.
+    """
+    django.setup()
+    warm_validators()
+
+
+def get_content_hash(data):
+    """Returns a SHA-256 digest of the canonical JSON serialization of data.
+
+    Keys are sorted and whitespace removed, so equal documents always have
+    the same digest.
+    """
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_source_uri(data):
+    """Returns the source URI of transformed data, if it has one."""
+    for external_identifier in data.get("external_identifiers", []):
+        return external_identifier["identifier"]
+    return None
+
+
+class TransformedObjectEncoder(dict_codec.OdinEncoder):
+    """Encodes resources as plain dicts suitable for storing as JSON.
+
+    Type fields are omitted, and values which are not native JSON types (such
+    as datetimes) are serialized the same way the JSON codec would, so the
+    output matches a JSON round trip without the cost of one.
+    """
+
+    def __init__(self, include_virtual_fields=True, include_type_field=False):
+        super().__init__(include_virtual_fields, include_type_field)
+
+    def default(self, o):
+        if o.__class__ in json_codec.JSON_TYPES:
+            return json_codec.JSON_TYPES[o.__class__](o)
+        return super().default(o)
 
 
 class TransformError(Exception):
@@ -20,6 +73,11 @@ class TransformError(Exception):
     pass
 
 
+class TransformValidationError(TransformError):
+    """Raised when transformed data fails validation."""
+    pass
+
+
 class Transformer:
     """Data Transformer.
 
@@ -32,15 +90,37 @@ class Transformer:
     """
 
     def run(self, object_type, data):
+        transformed = self.transform(object_type, data)
+        self.save_validated(transformed)
+        return transformed
+
+    def transform(self, object_type, data, should_validate=None):
+        """Transforms and validates data without saving it.
+
+        When settings.VALIDATION["sample_rate"] is greater than 1 only a
+        sample of records is validated; see validators.ValidationSampler.
+        Callers which sample records themselves pass `should_validate`, and
+        are responsible for recording validation failures.
+        """
         try:
             self.identifier = data.get("uri")
             from_resource, mapping, schema = self.get_mapping_classes(object_type)
             transformed = self.get_transformed_object(data, from_resource, mapping)
-            is_valid(transformed, schema)
-            self.save_validated(transformed)
+            sampled = should_validate is None
+            if sampled:
+                should_validate = sampler.should_validate(object_type)
+            if should_validate:
+                try:
+                    validate(transformed, schema)
+                except SchemaValidationError as e:
+                    if sampled:
+                        sampler.record_failure(object_type)
+                    raise TransformValidationError("Error transforming {} {}: {}".format(object_type, self.identifier, str(e)))
             return transformed
+        except TransformValidationError:
+            raise
         except ValidationError as e:
-            raise TransformError("Transformed data is invalid: {}".format(e))
+            raise TransformValidationError("Transformed data is invalid: {}".format(e))
         except Exception as e:
             raise TransformError("Error transforming {} {}: {}".format(object_type, self.identifier, str(e)))
 
@@ -57,31 +137,30 @@ class Transformer:
         return TYPE_MAP[object_type]
 
     def get_transformed_object(self, data, from_resource, mapping):
-        from_obj = json_codec.loads(json.dumps(data), resource=from_resource)
-        transformed = json.loads(json_codec.dumps(mapping.apply(from_obj)))
-        return self.remove_keys_from_dict(transformed)
-
-    def remove_keys_from_dict(self, data, target_key="$"):
-        """Removes all matching keys from dict."""
-        modified_dict = {}
-        if hasattr(data, 'items'):
-            for key, value in data.items():
-                if key != target_key:
-                    if isinstance(value, dict):
-                        modified_dict[key] = self.remove_keys_from_dict(data[key])
-                    elif isinstance(value, list):
-                        modified_dict[key] = [self.remove_keys_from_dict(i) for i in data[key]]
-                    else:
-                        modified_dict[key] = value
-        else:
-            return data
-        return modified_dict
-
-    def save_validated(self, data):
+        from_obj = dict_codec.load(data, resource=from_resource)
+        return dict_codec.dump(mapping.apply(from_obj), cls=TransformedObjectEncoder)
+
+    def save_validated(self, data, content_hash=None):
+        """Saves validated data as a DataObject.
+
+        DataObjects whose content has not changed are left untouched, so they
+        are not queued for indexing again. The identifier is recorded against
+        the source URI as an IdentifierMapping.
+
+        Returns:
+            bool: True if data was saved, False if it was unchanged.
+        """
         es_id = data["uri"].split("/")[-1]
+        content_hash = content_hash if content_hash else get_content_hash(data)
+        source_uri = get_source_uri(data)
+        if source_uri:
+            IdentifierMapping.objects.get_or_create(uri=source_uri, defaults={"es_id": es_id})
         try:
             existing = DataObject.objects.get(es_id=es_id)
+            if existing.content_hash == content_hash:
+                return False
             existing.data = data
+            existing.content_hash = content_hash
             existing.indexed = False
             existing.save()
         except DataObject.DoesNotExist:
@@ -89,4 +168,135 @@ class Transformer:
                 es_id=es_id,
                 object_type=data["type"],
                 data=data,
+                content_hash=content_hash,
                 indexed=False)
+        return True
+
+
+class DataObjectWriter:
+    """Buffers validated data and saves it as DataObjects in batches.
+
+    Each batch is written with a single INSERT ... ON CONFLICT statement,
+    which creates new DataObjects and updates existing ones whose content
+    hash has changed, and a second which records an IdentifierMapping for
+    each source URI. Counts of saved and unchanged objects are kept. A batch is
+    written when it reaches the configured size, or when the configured
+    number of seconds has passed since the last write. Call `flush` once all
+    data has been added.
+
+    If a batch cannot be written, its objects are saved one at a time, and
+    any which still cannot be saved are kept with the error raised until
+    `pop_failed` is called.
+
+    Saved objects are removed from pending DeleteRequests, so a replayed
+    request cannot delete an object which has since been recreated.
+
+    Args:
+        batch_size (int): number of objects to buffer before writing.
+        flush_interval (int): maximum seconds between writes.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size if batch_size else settings.PIPELINE["persist_batch_size"]
+        self.flush_interval = flush_interval if flush_interval else settings.PIPELINE["persist_flush_interval"]
+        self.buffer = {}
+        self.saved = 0
+        self.unchanged = 0
+        self.failed = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, data, content_hash=None):
+        """Adds validated data to the buffer, writing the batch if it is due."""
+        content_hash = content_hash if content_hash else get_content_hash(data)
+        with self.lock:
+            self.buffer[data["uri"].split("/")[-1]] = (data, content_hash)
+            due = (len(self.buffer) >= self.batch_size) or (time.monotonic() - self.last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered data to the database."""
+        with self.lock:
+            batch, self.buffer = self.buffer, {}
+            self.last_flush = time.monotonic()
+        if not batch:
+            return 0
+        failed = []
+        try:
+            with transaction.atomic():
+                saved = self.upsert(batch)
+        except Exception:
+            saved, failed = self.save_separately(batch)
+        failed_uris = set(uri for uri, _ in failed)
+        drop_delete_requests([es_id for es_id, (data, _) in batch.items() if data.get("uri") not in failed_uris])
+        with self.lock:
+            self.saved += saved
+            self.unchanged += len(batch) - saved - len(failed)
+            self.failed += failed
+        return saved
+
+    def save_separately(self, batch):
+        """Saves each object in a batch on its own.
+
+        Returns:
+            tuple: the number of objects saved, and a list of the URI of each
+            object which could not be saved with the error raised.
+        """
+        saved = 0
+        failed = []
+        for data, content_hash in batch.values():
+            try:
+                with transaction.atomic():
+                    saved += Transformer().save_validated(data, content_hash)
+            except Exception as e:
+                failed.append((data.get("uri"), str(e)))
+        return saved, failed
+
+    def pop_failed(self):
+        """Returns objects which could not be saved since the last call, with the errors raised."""
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def upsert(self, batch):
+        """Writes a batch of data, returning the number of rows written."""
+        now = timezone.now()
+        params = []
+        for es_id, (data, content_hash) in batch.items():
+            params += [es_id, data["type"], json.dumps(data), content_hash, False, now, now]
+        sql = (
+            "INSERT INTO {table} (es_id, object_type, data, content_hash, indexed, created, last_modified) "
+            "VALUES {values} "
+            "ON CONFLICT (es_id) DO UPDATE SET object_type = EXCLUDED.object_type, "
+            "data = EXCLUDED.data, content_hash = EXCLUDED.content_hash, "
+            "indexed = EXCLUDED.indexed, last_modified = EXCLUDED.last_modified "
+            "WHERE {table}.content_hash IS DISTINCT FROM EXCLUDED.content_hash "
+            "RETURNING es_id").format(
+                table=DataObject._meta.db_table,
+                values=", ".join(["(%s, %s, %s::jsonb, %s, %s, %s, %s)"] * len(batch)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            saved = len(cursor.fetchall())
+            self.save_mappings(cursor, batch)
+        return saved
+
+    def save_mappings(self, cursor, batch):
+        """Records the identifier of each object in a batch against its source URI."""
+        mappings = {}
+        for es_id, (data, _) in batch.items():
+            source_uri = get_source_uri(data)
+            if source_uri:
+                mappings[source_uri] = es_id
+        if not mappings:
+            return
+        now = timezone.now()
+        params = []
+        for uri, es_id in mappings.items():
+            params += [uri, es_id, now]
+        sql = (
+            "INSERT INTO {table} (uri, es_id, created) VALUES {values} "
+            "ON CONFLICT (uri) DO NOTHING").format(
+                table=IdentifierMapping._meta.db_table,
+                values=", ".join(["(%s, %s, %s)"] * len(mappings)))
+        cursor.execute(sql, params)
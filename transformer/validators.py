@@ -0,0 +1,116 @@
+import json
+import threading
+from collections import Counter
+
+import jsonschema
+from pisces import settings
+from rac_schemas import handle_schema_filename, is_date, schemas_dir
+from rac_schemas.exceptions import ValidationError
+
+SCHEMA_NAMES = ("agent.json", "collection.json", "object.json", "term.json")
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+_local = threading.local()
+
+
+def load_schema(filename):
+    """Returns a parsed schema file, reading it only once per process."""
+    with _schemas_lock:
+        if filename not in _schemas:
+            with open(schemas_dir / filename, "r") as sf:
+                _schemas[filename] = json.load(sf)
+        return _schemas[filename]
+
+
+def build_validator(schema_name):
+    """Builds a validator equivalent to the one used by rac_schemas.is_valid."""
+    object_schema = load_schema(handle_schema_filename(schema_name))
+    resolver = jsonschema.RefResolver.from_schema(load_schema("base.json"))
+    type_checker = jsonschema.Draft7Validator.TYPE_CHECKER.redefine("date", is_date)
+    validators = dict(jsonschema.Draft7Validator.VALIDATORS, date=is_date)
+    CustomValidator = jsonschema.validators.extend(
+        jsonschema.Draft7Validator,
+        type_checker=type_checker,
+        validators=validators)
+    return CustomValidator(object_schema, resolver=resolver)
+
+
+def get_validator(schema_name):
+    """Returns a compiled validator for a schema.
+
+    Validators are kept per thread, since their reference resolvers track
+    scope while validating and cannot be shared between threads.
+    """
+    if not hasattr(_local, "validators"):
+        _local.validators = {}
+    if schema_name not in _local.validators:
+        _local.validators[schema_name] = build_validator(schema_name)
+    return _local.validators[schema_name]
+
+
+def warm_validators():
+    """Compiles validators for all transformation schemas in this thread."""
+    for schema_name in SCHEMA_NAMES:
+        get_validator(schema_name)
+
+
+def validate(data, schema_name):
+    """Validates data against a JSON schema using a compiled validator.
+
+    Raises:
+        TypeError: if data is not a dict
+        rac_schemas.exceptions.ValidationError: if the validation fails
+    """
+    if not isinstance(data, dict):
+        raise TypeError("Data to be validated must be a dict, got {} instead".format(type(data)))
+    try:
+        get_validator(schema_name).validate(data)
+    except jsonschema.exceptions.ValidationError as e:
+        raise ValidationError(e)
+    return True
+
+
+class ValidationSampler:
+    """Decides which transformed records are validated.
+
+    With a sample rate of 1 every record is validated. Otherwise every Nth
+    record of each object type is validated, as well as every record of an
+    object type which failed validation within the last `failure_window`
+    records of that type.
+
+    Counts are kept in memory, so each process has its own. When records
+    are transformed in a pool of processes, the parent process makes the
+    decision and passes it on; see fetchers.BaseDataFetcher.transform_stage.
+
+    Args:
+        sample_rate (int): validate one in every sample_rate records.
+        failure_window (int): number of records of an object type to validate
+            after a validation failure.
+    """
+
+    def __init__(self, sample_rate=1, failure_window=1000):
+        self.sample_rate = max(int(sample_rate), 1)
+        self.failure_window = failure_window
+        self.seen = Counter()
+        self.failing = Counter()
+        self.lock = threading.Lock()
+
+    def should_validate(self, object_type):
+        if self.sample_rate == 1:
+            return True
+        with self.lock:
+            self.seen[object_type] += 1
+            if self.failing[object_type] > 0:
+                self.failing[object_type] -= 1
+                return True
+            return self.seen[object_type] % self.sample_rate == 1
+
+    def record_failure(self, object_type):
+        with self.lock:
+            self.failing[object_type] = self.failure_window
+
+
+sampler = ValidationSampler(
+    settings.VALIDATION["sample_rate"],
+    failure_window=settings.VALIDATION["failure_window"])